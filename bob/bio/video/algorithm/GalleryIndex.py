@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import numpy
+
+from .. import utils
+
+import logging
+logger = logging.getLogger("bob.bio.video")
+
+class GalleryIndex:
+  """An index of enrolled video models for fast identification, i.e., for searching the best matching models of a probe video in a large gallery.
+
+  The index is an inverted file: the frame features of all models are clustered into ``number_of_lists`` lists with k-means, and each model is stored in the lists of its frames.
+  A search only considers the models in the ``lists_per_frame`` lists that are closest to each probe frame.
+  Of these, the ``max_candidates`` models with the smallest distance between any of their frames and any probe frame are re-ranked with the exact scores of the given ``algorithm``, see :py:meth:`bob.bio.video.algorithm.Wrapper.score_models`.
+
+  The lists are built at the first search, or by calling :py:meth:`build`.
+  Models that are added later are put into the lists of the existing clusters; call :py:meth:`build` again after the gallery has changed a lot.
+
+  The models need to be feature vectors or lists of feature vectors of the same size, see :py:func:`bob.bio.video.stack_frames`.
+  The frames are compared with the ``frame_scorer`` of the ``algorithm``, or with cosine similarity if it has none.
+
+  **Parameters:**
+
+  algorithm : :py:class:`bob.bio.video.algorithm.Wrapper`
+    The algorithm that selects the probe frames and computes the exact scores.
+
+  number_of_lists : int
+    The number of clusters of the frame features.
+
+  lists_per_frame : int
+    The number of closest lists searched for each probe frame.
+
+  max_candidates : int
+    The maximum number of models that are scored with the ``algorithm``.
+  """
+
+  def __init__(self, algorithm, number_of_lists = 64, lists_per_frame = 4, max_candidates = 100):
+    self.algorithm = algorithm
+    self.scorer = algorithm.frame_scorer or 'cosine'
+    self.number_of_lists = number_of_lists
+    self.lists_per_frame = lists_per_frame
+    self.max_candidates = max_candidates
+    self._clear()
+
+  def _clear(self):
+    """Removes all models from the index."""
+    self._ids = []
+    self._models = []
+    # the stacked (and normalized) frame features of each model
+    self._vectors = []
+    # the cluster centers and the positions of the models in each list
+    self._centroids = None
+    self._lists = None
+
+  def __len__(self):
+    return len(self._ids)
+
+  def _stack(self, frames):
+    """Stacks the given frames into the vectors used for clustering."""
+    vectors = utils.stack_frames(frames)
+    if self.scorer == 'cosine':
+      # with unit vectors, the Euclidean distance ranks frames like the cosine similarity
+      norms = numpy.sqrt((vectors ** 2).sum(axis=1))
+      norms[norms == 0] = 1.
+      vectors = vectors / norms[:, None]
+    return vectors
+
+  def _nearest_lists(self, vectors, count):
+    """Returns the indices of the ``count`` closest lists for each of the given vectors."""
+    distances = -utils.score_matrix(self._centroids, vectors, 'euclidean')
+    return numpy.argsort(distances, axis=0)[:count]
+
+  def _assign(self, position, vectors):
+    """Adds the model at the given position to the lists of its frames."""
+    for index in set(self._nearest_lists(vectors, 1).ravel()):
+      self._lists[index].add(position)
+
+  def add(self, model_id, model):
+    """Adds the given enrolled model with the given id to the index."""
+    self._ids.append(str(model_id))
+    self._models.append(model)
+    self._vectors.append(self._stack(model))
+    if self._centroids is not None:
+      self._assign(len(self._ids) - 1, self._vectors[-1])
+
+  def build(self):
+    """Clusters the frame features of all models and builds the lists of the index."""
+    vectors = numpy.concatenate(self._vectors)
+    logger.info("Clustering %d frames of %d models into %d lists", len(vectors), len(self._ids), min(self.number_of_lists, len(vectors)))
+    self._centroids = numpy.array(utils.pool_frames(list(vectors), pooling = 'k-means', k = self.number_of_lists))
+    self._lists = [set() for _ in range(len(self._centroids))]
+    for position, vectors in enumerate(self._vectors):
+      self._assign(position, vectors)
+
+  def search(self, probe, k = 10):
+    """search(probe, k = 10) -> results
+
+    Searches the models that match the given probe video best.
+
+    **Parameters:**
+
+    probe : :py:class:`bob.bio.video.FrameContainer`
+      The extracted or projected features of the probe video.
+
+    k : int
+      The maximum number of models to return.
+
+    **Returns:**
+
+    results : [(str, float)]
+      The ids of the best matching models and their scores, sorted by decreasing score.
+    """
+    if not self._ids:
+      return []
+    if self._centroids is None:
+      self.build()
+
+    # collect the models in the closest lists of the probe frames
+    probe_vectors = self._stack(self.algorithm.frame_selector(probe))
+    candidates = set()
+    for index in self._nearest_lists(probe_vectors, self.lists_per_frame).ravel():
+      candidates.update(self._lists[index])
+    if not candidates:
+      return []
+    candidates = sorted(candidates)
+    if len(candidates) > self.max_candidates:
+      # keep the models with the closest frames to the probe frames
+      vectors = [self._vectors[position] for position in candidates]
+      distances = -utils.score_matrix(numpy.concatenate(vectors), probe_vectors, 'euclidean')
+      closest = numpy.minimum.reduceat(distances.min(axis=1), numpy.cumsum([0] + [len(v) for v in vectors[:-1]]))
+      candidates = [candidates[i] for i in numpy.argsort(closest, kind = 'mergesort')[:self.max_candidates]]
+
+    # re-rank the candidates with the exact scores
+    scores = self.algorithm.score_models([self._models[position] for position in candidates], probe)
+    order = numpy.argsort(-scores, kind = 'mergesort')[:k]
+    return [(self._ids[candidates[i]], float(scores[i])) for i in order]
+
+  def save(self, hdf5):
+    """Saves the models and the cluster centers of the index to the given :py:class:`bob.io.base.HDF5File` opened for writing."""
+    for i, (model_id, model) in enumerate(zip(self._ids, self._models)):
+      hdf5.append("ModelIds", model_id)
+      hdf5.set("Model_%d" % i, numpy.asarray(model))
+    if self._centroids is not None:
+      hdf5.set("Centroids", self._centroids)
+
+  def load(self, hdf5):
+    """Loads the models and the cluster centers of the index from the given :py:class:`bob.io.base.HDF5File`.
+    The lists of the index are rebuilt without clustering again."""
+    self._clear()
+    if hdf5.has_key("ModelIds"):
+      for i, model_id in enumerate(hdf5.lread("ModelIds")):
+        self.add(model_id, hdf5.read("Model_%d" % i))
+    if hdf5.has_key("Centroids"):
+      self._centroids = hdf5.read("Centroids")
+      self._lists = [set() for _ in range(len(self._centroids))]
+      for position, vectors in enumerate(self._vectors):
+        self._assign(position, vectors)
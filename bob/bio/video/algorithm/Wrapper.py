@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 # vim: set fileencoding=utf-8 :
 
+import os
 import six
+import numpy
 import bob.bio.base
 import bob.io.base
 
@@ -16,6 +18,26 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
   This algorithm now uses these features to perform face recognition, i.e., by enrolling a model from several frames (possibly of several videos), and fusing scores from several model frames and several probe frames.
   Since the functionality to handle several images for enrollment and probing is already implemented in the wrapped class, here we only care about providing the right data at the right time.
 
+  If the ``algorithm`` provides a function ``project_batch(features) -> projected``, several frames are projected with one call, e.g., with a single matrix multiplication for linear projections.
+  It gets a stack of features as a :py:class:`numpy.ndarray` and returns the list (or array) of projected features.
+  Up to ``batch_size`` frames are passed at once.
+
+  To train the projector with more frames than fit into memory, read the training features with ``lazy_io`` (see :py:class:`bob.bio.video.extractor.Wrapper`) and set either ``training_batch_size`` or ``max_training_frames``.
+  If the ``algorithm`` provides a function ``train_projector_batches(batches, projector_file)``, it is called with a generator of mini-batches of at most ``training_batch_size`` frames, see :py:func:`bob.bio.video.training_batches`.
+  Otherwise, at most ``max_training_frames`` frames are sampled at random with bounded memory, see :py:func:`bob.bio.video.reservoir_sample`, and passed to the ``train_projector`` function of the ``algorithm``.
+
+  By default, the scores between a model and the probe frames are computed and fused by the ``score_for_multiple_probes`` function of the ``algorithm``.
+  If a ``frame_scorer`` is given instead, the model frames and the probe frames are stacked into matrices, and all frame-by-frame scores are computed with one matrix multiplication, see :py:func:`bob.bio.video.score_matrix`.
+  This requires models that are (lists of) feature vectors, and the scores are fused as given by ``score_fusion``, see :py:func:`bob.bio.video.fuse_scores`.
+
+  By default, the features of all frames of all enrollment videos are passed to the ``enroll`` function of the ``algorithm``.
+  If an ``enroll_pooling`` is given, these features are first aggregated into ``pooled_frames`` frames (or a single frame for the mean), see :py:func:`bob.bio.video.pool_frames`.
+  Hence, the size of the models and the time to score them do not depend on the length of the enrollment videos.
+
+  During scoring, the same model and probe files are often read many times, e.g., for the different score matrices of ZT-norm.
+  With ``model_cache_size`` and ``feature_cache_size``, the models and the probe frame containers read by :py:meth:`read_model` and :py:meth:`read_feature` are kept in the :py:class:`bob.bio.video.LRUCache`\\s :py:attr:`model_cache` and :py:attr:`feature_cache`, which count their hits and misses.
+  Files are identified by their name and modification time.
+
   **Parameters:**
 
   algorithm :  str or :py:class:`bob.bio.base.algorithm.Algorithm` instance
@@ -28,14 +50,87 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
   compressed_io : bool
     Use compression to write the projected features to HDF5 files.
     This is experimental and might cause trouble.
-    Use this flag with care.
+    Use this flag with care, or consider using ``hdf5_compression`` instead.
+
+  hdf5_layout : str
+    The on-disk layout of the written HDF5 files, either ``'groups'`` or ``'dataset'``, see :py:meth:`bob.bio.video.FrameContainer.save`.
+    The ``'dataset'`` layout stores the frames as raw arrays and bypasses the IO functions of the wrapped class.
+    Files written in either layout can be read.
+
+  lazy_io : bool
+    Read the frames of uncompressed files only when they are accessed, see :py:func:`bob.bio.video.load_lazy`.
+    This saves time and memory when the ``frame_selector`` of the next stage keeps only a few frames.
+
+  hdf5_compression : int
+    The gzip compression level between 0 (no compression) and 9, which is used to compress the frames inside the HDF5 files.
+    Requires ``hdf5_layout='dataset'``; single frames can still be read without decompressing the whole file.
+    Cannot be combined with ``compressed_io``, which compresses whole files.
+
+  batch_size : int or ``None``
+    The maximum number of frames passed to the ``project_batch`` function of the ``algorithm``, if it provides one.
+    If ``None``, all selected frames of a video are passed at once.
+
+  training_batch_size : int or ``None``
+    The number of frames in the mini-batches passed to the ``train_projector_batches`` function of the ``algorithm``, if it provides one.
+    Mini-batches are not used when the training features are split by client.
+
+  max_training_frames : int or ``None``
+    If given, the projector is trained with at most this number of frames (per client, if the training features are split by client), which are sampled with a fixed random seed.
+
+  frame_scorer : str or ``None``
+    The similarity of model frames and probe frames, one of ``'cosine'``, ``'euclidean'`` or ``'dot'``; if ``None``, the ``algorithm`` computes the scores.
+
+  score_fusion : str or callable
+    The fusion of the frame-by-frame scores when a ``frame_scorer`` is used, one of ``'max'``, ``'mean'``, ``'median'``, ``'top-k'`` or ``'quality-weighted'``, or a function ``fusion(scores, qualities) -> score``.
+
+  fusion_top_k : int
+    The number of the highest scores that are averaged by the ``'top-k'`` fusion.
+
+  enroll_pooling : str or ``None``
+    The aggregation of the enrollment features, one of ``'mean'``, ``'quality-weighted'``, ``'k-means'`` or ``'k-medoids'``; if ``None``, the features of all frames are used.
+
+  pooled_frames : int
+    The number of frames returned by the ``'k-means'`` and ``'k-medoids'`` pooling.
+
+  model_cache_size : int
+    The maximum size of the cached models in bytes; if 0, models are not cached.
+
+  feature_cache_size : int
+    The maximum size of the cached probe features in bytes; if 0, features are not cached.
 
   """
   def __init__(self,
       algorithm,
       frame_selector = utils.FrameSelector(selection_style='all'),
-      compressed_io = False
+      compressed_io = False,
+      hdf5_layout = 'groups',
+      lazy_io = False,
+      hdf5_compression = 0,
+      batch_size = None,
+      training_batch_size = None,
+      max_training_frames = None,
+      frame_scorer = None,
+      score_fusion = 'mean',
+      fusion_top_k = 5,
+      enroll_pooling = None,
+      pooled_frames = 1,
+      model_cache_size = 0,
+      feature_cache_size = 0
   ):
+    if hdf5_compression and hdf5_layout != 'dataset':
+      raise ValueError("The hdf5_compression requires the 'dataset' hdf5_layout")
+    if hdf5_compression and compressed_io:
+      raise ValueError("The hdf5_compression cannot be used together with compressed_io")
+
+    if frame_scorer not in (None,) + utils.scoring.SCORERS:
+      raise ValueError("Unknown frame scorer '%s', choose one of %s" % (frame_scorer, (None,) + utils.scoring.SCORERS))
+
+    if not callable(score_fusion) and score_fusion not in utils.scoring.FUSIONS:
+      raise ValueError("Unknown score fusion '%s', choose one of %s" % (score_fusion, utils.scoring.FUSIONS))
+
+    if enroll_pooling not in (None,) + utils.scoring.POOLINGS:
+      raise ValueError("Unknown enroll pooling '%s', choose one of %s" % (enroll_pooling, (None,) + utils.scoring.POOLINGS))
+
     # load algorithm configuration
     if isinstance(algorithm, six.string_types):
       self.algorithm = bob.bio.base.load_resource(algorithm, "algorithm")
@@ -53,7 +148,20 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
         self.algorithm.requires_enroller_training,
         algorithm=algorithm,
         frame_selector=frame_selector,
-        compressed_io=compressed_io
+        compressed_io=compressed_io,
+        hdf5_layout=hdf5_layout,
+        lazy_io=lazy_io,
+        hdf5_compression=hdf5_compression,
+        batch_size=batch_size,
+        training_batch_size=training_batch_size,
+        max_training_frames=max_training_frames,
+        frame_scorer=frame_scorer,
+        score_fusion=score_fusion,
+        fusion_top_k=fusion_top_k,
+        enroll_pooling=enroll_pooling,
+        pooled_frames=pooled_frames,
+        model_cache_size=model_cache_size,
+        feature_cache_size=feature_cache_size
     )
 
     self.frame_selector = frame_selector
@@ -61,6 +169,19 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
     # otherwise select frames during enrollment (or enroller training)
     self.enroll_frame_selector = (lambda i : i) if self.use_projected_features_for_enrollment else frame_selector
     self.compressed_io = compressed_io
+    self.hdf5_layout = hdf5_layout
+    self.lazy_io = lazy_io
+    self.hdf5_compression = hdf5_compression
+    self.batch_size = batch_size
+    self.training_batch_size = training_batch_size
+    self.max_training_frames = max_training_frames
+    self.frame_scorer = frame_scorer
+    self.score_fusion = score_fusion
+    self.fusion_top_k = fusion_top_k
+    self.enroll_pooling = enroll_pooling
+    self.pooled_frames = pooled_frames
+    self.model_cache = utils.LRUCache(model_cache_size) if model_cache_size else None
+    self.feature_cache = utils.LRUCache(feature_cache_size) if feature_cache_size else None
 
 
   def _check_feature(self, frames):
@@ -88,12 +209,21 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
     """
     if self.split_training_features_by_client:
       [self._check_feature(frames) for client_frames in training_frames for frames in client_frames]
-      training_features = [[frame[1] for frames in client_frames for frame in self.frame_selector(frames)] for client_frames in training_frames]
+      training_features = [self._training_features(client_frames) for client_frames in training_frames]
     else:
       [self._check_feature(frames) for frames in training_frames]
-      training_features = [frame[1] for frames in training_frames for frame in self.frame_selector(frames)]
+      if self.training_batch_size and hasattr(self.algorithm, 'train_projector_batches'):
+        # stream the frames in mini-batches
+        return self.algorithm.train_projector_batches(utils.training_batches(training_frames, self.frame_selector, self.training_batch_size), projector_file)
+      training_features = self._training_features(training_frames)
     self.algorithm.train_projector(training_features, projector_file)
 
+  def _training_features(self, training_frames):
+    """Returns the selected frames of the given frame containers, sampling at most ``max_training_frames``."""
+    if self.max_training_frames:
+      return utils.reservoir_sample(training_frames, self.frame_selector, self.max_training_frames, seed = 0)
+    return [frame[1] for frames in training_frames for frame in self.frame_selector(frames)]
+
 
   def load_projector(self, projector_file):
     """Loads the trained extractor from file.
@@ -125,16 +255,22 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
     """
     self._check_feature(frames)
     fc = utils.FrameContainer()
-    for index, frame, quality in self.frame_selector(frames):
-      # extract features
-      projected = self.algorithm.project(frame)
-      # add image to frame container
-      fc.add(index, projected, quality)
+    selected = self.frame_selector(frames)
+    if hasattr(self.algorithm, 'project_batch'):
+      for indices, data, qualities in selected.batches(self.batch_size):
+        for index, projected, quality in zip(indices, self.algorithm.project_batch(data), qualities):
+          fc.add(index, projected, quality)
+    else:
+      for index, frame, quality in selected:
+        # extract features
+        projected = self.algorithm.project(frame)
+        # add image to frame container
+        fc.add(index, projected, quality)
     return fc
 
 
-  def read_feature(self, projected_file):
-    """read_feature(projected_file) -> frames
+  def read_feature(self, projected_file, frame_selector = None):
+    """read_feature(projected_file, frame_selector = None) -> frames
 
     Reads the projected data from file and returns them in a frame container.
     The algorithms ``read_feature`` function is used to read the data for each frame.
@@ -144,15 +280,26 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
     filename : str
       The name of the projected data file.
 
+    frame_selector : :py:class:`bob.bio.video.FrameSelector` or ``None``
+      If given, only the frames selected by this frame selector are read from file.
+
     **Returns:**
 
     frames : :py:class:`bob.bio.video.FrameContainer`
       The read frames, stored in a frame container.
     """
+    if self.feature_cache is not None and frame_selector is None:
+      return self.feature_cache.get(_cache_key(projected_file), lambda: self._read_feature(projected_file))
+    return self._read_feature(projected_file, frame_selector)
+
+  def _read_feature(self, projected_file, frame_selector = None):
+    """Reads the projected data from file, see :py:meth:`read_feature`."""
     if self.compressed_io:
-      return utils.load_compressed(projected_file, self.algorithm.read_feature)
+      return utils.load_compressed(projected_file, self.algorithm.read_feature, frame_selector)
+    elif self.lazy_io and frame_selector is None and self.feature_cache is None:
+      return utils.load_lazy(projected_file, self.algorithm.read_feature)
     else:
-      return utils.FrameContainer(bob.io.base.HDF5File(projected_file), self.algorithm.read_feature)
+      return utils.FrameContainer(bob.io.base.HDF5File(projected_file), self.algorithm.read_feature, frame_selector)
 
 
   def write_feature(self, frames, projected_file):
@@ -170,9 +317,9 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
     """
     self._check_feature(frames)
     if self.compressed_io:
-      return utils.save_compressed(frames, projected_file, self.algorithm.write_feature)
+      return utils.save_compressed(frames, projected_file, self.algorithm.write_feature, layout=self.hdf5_layout)
     else:
-      frames.save(bob.io.base.HDF5File(projected_file, 'w'), self.algorithm.write_feature)
+      frames.save(bob.io.base.HDF5File(projected_file, 'w'), self.algorithm.write_feature, self.hdf5_layout, self.hdf5_compression)
 
 
   # ENROLLMENT
@@ -214,6 +361,7 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
     Enrolls the model from features of all selected frames of all enrollment videos for the current client.
 
     This function collects all desired frames from all enrollment videos and enrolls a model with that, using the algorithms ``enroll`` function.
+    If an ``enroll_pooling`` is given, the features of the frames are aggregated before, see :py:func:`bob.bio.video.pool_frames`.
 
     **Parameters:**
 
@@ -226,7 +374,10 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
       The model as created by the algorithms ``enroll`` function.
     """
     [self._check_feature(frames) for frames in enroll_frames]
-    features = [frame[1] for frames in enroll_frames for frame in self.enroll_frame_selector(frames)]
+    frames = [frame for frames in enroll_frames for frame in self.enroll_frame_selector(frames)]
+    features = [frame[1] for frame in frames]
+    if self.enroll_pooling is not None:
+      features = utils.pool_frames(features, [frame[2] for frame in frames], self.enroll_pooling, self.pooled_frames)
     return self.algorithm.enroll(features)
 
 
@@ -259,6 +410,8 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
     model : object
       The model read from file.
     """
+    if self.model_cache is not None:
+      return self.model_cache.get(_cache_key(filename), lambda: self.algorithm.read_model(filename))
     return self.algorithm.read_model(filename)
 
   def score(self, model, probe):
@@ -283,6 +436,8 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
     score : float
       A fused score between the given model and all probe frames.
     """
+    if self.frame_scorer is not None:
+      return self._fused_score(self._model_matrix(model), [self.frame_selector(probe)])
     features = [frame[1] for frame in self.frame_selector(probe)]
     return self.algorithm.score_for_multiple_probes(model, features)
 
@@ -310,8 +465,83 @@ class Wrapper (bob.bio.base.algorithm.Algorithm):
       A fused score between the given model and all probe frames.
     """
     [self._check_feature(frames) for frames in probes]
-    probe = [frame[1] for frame in probe for probe in probes]
+    if self.frame_scorer is not None:
+      return self._fused_score(self._model_matrix(model), [self.frame_selector(frames) for frames in probes])
+    probe = [frame[1] for frames in probes for frame in self.frame_selector(frames)]
     return self.algorithm.score_for_multiple_probes(model, probe)
 
-  # re-define some functions to avoid them being falsely documented
-  def score_for_multiple_models(*args,**kwargs): raise NotImplementedError("This function is not implemented and should not be called.")
+  def _model_matrix(self, model):
+    """Stacks the frames of the given model into a matrix for the ``frame_scorer``."""
+    try:
+      return utils.stack_frames(model)
+    except (ValueError, TypeError):
+      raise ValueError("The frame_scorer requires models that are feature vectors or lists of feature vectors of the same size")
+
+  def _fused_score(self, model_matrix, probes):
+    """Computes the fused score between the given stacked model frames and all frames of the given (selected) probe frame containers."""
+    probe_matrix = numpy.concatenate([utils.stack_frames(frames) for frames in probes])
+    qualities = [quality for frames in probes for quality in frames.qualities()]
+    scores = utils.score_matrix(model_matrix, probe_matrix, self.frame_scorer)
+    return utils.fuse_scores(scores, self.score_fusion, qualities, self.fusion_top_k)
+
+  def score_models(self, models, probe):
+    """score_models(models, probe) -> scores
+
+    Computes the scores between each of the given models and the probe.
+
+    The frames of the probe are selected only once.
+    If a ``frame_scorer`` is given, the frames of all models are stacked into a single matrix, and the scores of all models are computed with one matrix multiplication and fused at once, see :py:func:`bob.bio.video.fuse_score_blocks`.
+    Otherwise, the algorithms ``score_for_multiple_probes`` function is called for each model.
+
+    **Parameters:**
+
+    models : [object]
+      The models in the type desired by the wrapped algorithm.
+
+    probe : :py:class:`bob.bio.video.FrameContainer`
+      The selected frames from the probe objects, which contains the probes are desired by the wrapped algorithm.
+
+    **Returns:**
+
+    scores : :py:class:`numpy.ndarray`
+      The fused score between each model and all probe frames.
+    """
+    selected = self.frame_selector(probe)
+    if not len(models):
+      return numpy.zeros((0,))
+    if self.frame_scorer is None:
+      features = [frame[1] for frame in selected]
+      return numpy.array([self.algorithm.score_for_multiple_probes(model, features) for model in models])
+
+    model_matrices = [self._model_matrix(model) for model in models]
+    scores = utils.score_matrix(numpy.concatenate(model_matrices), utils.stack_frames(selected), self.frame_scorer)
+    return utils.fuse_score_blocks(scores, [len(m) for m in model_matrices], self.score_fusion, selected.qualities(), self.fusion_top_k)
+
+
+  def score_for_multiple_models(self, models, probe):
+    """score_for_multiple_models(models, probe) -> score
+
+    Computes the score between the given list of models (of the same client) and the probe.
+
+    The scores for all models are computed by :py:meth:`score_models`, and fused by the model fusion function of the wrapped algorithm.
+    Use :py:meth:`score_models` to get the score for each model, e.g., to compare a probe with a watch-list.
+
+    **Parameters:**
+
+    models : [object]
+      The models in the type desired by the wrapped algorithm.
+
+    probe : :py:class:`bob.bio.video.FrameContainer`
+      The selected frames from the probe objects, which contains the probes are desired by the wrapped algorithm.
+
+    **Returns:**
+
+    score : float
+      The fused score between all models and all probe frames.
+    """
+    return self.algorithm.model_fusion_function(self.score_models(models, probe))
+
+
+def _cache_key(filename):
+  """Returns the key of the given file in the model and feature caches."""
+  return (os.path.abspath(filename), os.path.getmtime(filename))
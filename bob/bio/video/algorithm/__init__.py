@@ -1,4 +1,5 @@
 from .Wrapper import Wrapper
+from .GalleryIndex import GalleryIndex
 
 # gets sphinx autodoc done right - don't remove it
 def __appropriate__(*args):
@@ -17,5 +18,6 @@ def __appropriate__(*args):
 
 __appropriate__(
     Wrapper,
+    GalleryIndex,
     )
 __all__ = [_ for _ in dir() if not _.startswith('_')]
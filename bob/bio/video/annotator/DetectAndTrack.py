@@ -0,0 +1,183 @@
+from . import Base
+import bob.bio.base
+import collections
+import logging
+import numpy
+import six
+
+logger = logging.getLogger(__name__)
+
+
+class DetectAndTrack(Base):
+  """A video annotator that runs the (expensive) image annotator on some
+  keyframes only and tracks the face in the frames in between.
+
+  The image annotator is run on every ``detection_interval``-th frame. The
+  bounding box found there is used as a template, which is searched in a
+  window around the previous location in the following frames using
+  normalized cross-correlation on downsampled gray images. All annotated
+  points (e.g. eye positions) are moved by the displacement of the bounding
+  box. If the correlation drops below ``min_confidence``, or no face is
+  tracked, the image annotator is run again on the current frame. Annotations
+  of the image annotator without a bounding box are returned as they are, but
+  cannot be tracked, so the image annotator is run on the next frame again.
+
+  Parameters
+  ----------
+  annotator : :any:`bob.bio.base.annotator.Annotator` or str
+      The image annotator used on keyframes. It needs to return the
+      ``topleft`` and ``bottomright`` corners of the face bounding box. The
+      annotator could also be the name of a bob.bio.annotator resource which
+      will be loaded.
+  detection_interval : int
+      The number of frames after which the image annotator is run again.
+  search_margin : float
+      The size of the search window around the previous bounding box, relative
+      to the size of the bounding box.
+  min_confidence : float
+      The minimum normalized cross-correlation in ``[-1, 1]`` to accept a
+      tracked location.
+  template_size : int
+      The approximate size in pixels of the downsampled template that is
+      searched.
+
+
+  Please see :any:`Base` for more accepted parameters.
+  """
+
+  def __init__(self, annotator, detection_interval=10, search_margin=0.25,
+               min_confidence=0.7, template_size=24, **kwargs):
+    super(DetectAndTrack, self).__init__(**kwargs)
+    assert detection_interval > 0, \
+        "detection_interval: `{}' cannot be less than 1".format(
+            detection_interval)
+    self.annotator = annotator
+    if isinstance(annotator, six.string_types):
+      self.annotator = bob.bio.base.load_resource(annotator, "annotator")
+    self.detection_interval = detection_interval
+    self.search_margin = search_margin
+    self.min_confidence = min_confidence
+    self.template_size = template_size
+
+  def annotate(self, frames, **kwargs):
+    """See :any:`Base.annotate`
+    """
+    frame_ids, frames = self.frame_ids_and_frames(frames)
+    annotations = collections.OrderedDict()
+    # the last detected annotations, the template and the box they belong to
+    detected, template, box = None, None, None
+    # the box of the previous frame
+    previous = None
+    age = 0
+    for i, frame in zip(frame_ids, frames):
+      gray = _gray(frame)
+      current = None
+      if detected is not None and age < self.detection_interval:
+        current_box, confidence = self._track(gray, template, previous)
+        if confidence >= self.min_confidence:
+          current = _shift(detected, current_box[0] - box[0],
+                           current_box[1] - box[1])
+          previous = current_box
+          age += 1
+        else:
+          logger.debug("Lost track in frame `%s' with confidence %f", i,
+                       confidence)
+
+      if current is None:
+        # (re-)detect the face
+        current = self.annotator.annotate(frame, **kwargs) or None
+        # annotations without a bounding box are kept, but not tracked
+        detected = None
+        if current is not None and 'topleft' in current and \
+            'bottomright' in current:
+          box = _box(current, gray.shape)
+          template = self._template(gray, box)
+          if template.size:
+            detected, previous, age = current, box, 1
+
+      annotations[i] = current
+    return annotations
+
+  def _step(self, box):
+    """The subsampling step used for the given bounding box."""
+    return max(1, min(box[2] - box[0], box[3] - box[1]) //
+               self.template_size)
+
+  def _template(self, gray, box):
+    step = self._step(box)
+    return gray[box[0]:box[2]:step, box[1]:box[3]:step]
+
+  def _track(self, gray, template, box):
+    """Searches the template around the given box and returns the best box
+    and its normalized cross-correlation."""
+    top, left, bottom, right = box
+    height, width = bottom - top, right - left
+    step = self._step(box)
+    margin = int(self.search_margin * max(height, width))
+    template = template - template.mean()
+    template_norm = numpy.sqrt((template ** 2).sum())
+    if template_norm == 0:
+      return box, -1.
+    first_y, last_y = max(0, top - margin), min(gray.shape[0] - height, top + margin)
+    first_x, last_x = max(0, left - margin), min(gray.shape[1] - width, left + margin)
+    # search a coarse grid of positions first
+    y, x, confidence = _best_match(gray, template, template_norm, step,
+                                   range(first_y, last_y + 1, step),
+                                   range(first_x, last_x + 1, step))
+    if y is None:
+      return box, -1.
+    if step > 1:
+      # then search every position around the best position of the grid
+      y, x, confidence = _best_match(gray, template, template_norm, step,
+                                     range(max(first_y, y - step + 1), min(last_y, y + step - 1) + 1),
+                                     range(max(first_x, x - step + 1), min(last_x, x + step - 1) + 1))
+    return (y, x, y + height, x + width), confidence
+
+
+def _best_match(gray, template, template_norm, step, ys, xs):
+  """Returns the top-left position (y, x) of the patch of the given gray image
+  with the highest normalized cross-correlation to the given zero-mean
+  template, which was sampled with the given step, and the correlation.
+  The position is ``None`` if all patches are constant."""
+  height, width = template.shape[0] * step, template.shape[1] * step
+  best_y, best_x, best_confidence = None, None, -1.
+  for y in ys:
+    for x in xs:
+      patch = gray[y:y + height:step, x:x + width:step]
+      patch = patch - patch.mean()
+      norm = numpy.sqrt((patch ** 2).sum()) * template_norm
+      if norm == 0:
+        continue
+      confidence = (patch * template).sum() / norm
+      if confidence > best_confidence:
+        best_y, best_x, best_confidence = y, x, confidence
+  return best_y, best_x, best_confidence
+
+
+def _gray(frame):
+  """Converts the given (color) frame into a gray image of floats."""
+  frame = numpy.asarray(frame, numpy.float64)
+  if frame.ndim == 3:
+    frame = frame.mean(axis=0)
+  return frame
+
+
+def _box(annotations, shape):
+  """Returns the integral bounding box (top, left, bottom, right) of the given
+  annotations, limited to the image of the given shape."""
+  top, left = [int(round(v)) for v in annotations['topleft']]
+  bottom, right = [int(round(v)) for v in annotations['bottomright']]
+  top, left = max(0, top), max(0, left)
+  bottom, right = min(shape[0], bottom), min(shape[1], right)
+  return (top, left, bottom, right)
+
+
+def _shift(annotations, dy, dx):
+  """Moves all points of the given annotations by the given displacement."""
+  shifted = {}
+  for key, value in annotations.items():
+    if isinstance(value, (tuple, list)) and len(value) == 2:
+      shifted[key] = (value[0] + dy, value[1] + dx)
+    else:
+      shifted[key] = value
+  return shifted
@@ -0,0 +1,89 @@
+from . import Base
+from .. import utils
+import bob.bio.base
+import bob.ip.base
+import numpy
+import six
+
+
+class Downscaled(Base):
+  """Annotates downscaled copies of the frames with the given video annotator
+  and rescales the resulting annotations to the original resolution.
+
+  Face detectors spend most of their time searching large frames, while faces
+  that fill a sizeable part of the frame can be found as well in a downscaled
+  copy. Only the annotation is computed on the downscaled frames; the
+  preprocessor still crops the faces from the frames in full resolution.
+
+  Either ``scale`` or ``max_size`` needs to be given. Frames that are smaller
+  than ``max_size`` are annotated in their original resolution.
+
+  Parameters
+  ----------
+  annotator : :any:`Base` or str
+      The video annotator used on the downscaled frames. The annotator could
+      also be the name of a bob.bio.annotator resource which will be loaded.
+  scale : float or ``None``
+      The factor in ``(0, 1]`` by which the frames are downscaled.
+  max_size : int or ``None``
+      The frames are downscaled such that their larger side has at most
+      ``max_size`` pixels.
+
+
+  Please see :any:`Base` for more accepted parameters.
+  """
+
+  def __init__(self, annotator, scale=None, max_size=None, **kwargs):
+    super(Downscaled, self).__init__(**kwargs)
+    assert (scale is None) != (max_size is None), \
+        "Exactly one of scale and max_size needs to be given"
+    assert scale is None or 0 < scale <= 1, \
+        "scale: `{}' needs to be in (0, 1]".format(scale)
+    assert max_size is None or max_size > 0, \
+        "max_size: `{}' cannot be less than 1".format(max_size)
+    self.annotator = annotator
+    if isinstance(annotator, six.string_types):
+      self.annotator = bob.bio.base.load_resource(annotator, "annotator")
+    self.scale = scale
+    self.max_size = max_size
+
+  def annotate(self, frames, **kwargs):
+    """See :any:`Base.annotate`
+    """
+    frame_ids, frames = self.frame_ids_and_frames(frames)
+    scale = self.scale
+    if scale is None:
+      scale = min(1., float(self.max_size) / max(frames.shape[-2:]))
+
+    # keep the frame ids of the original frames
+    downscaled = utils.FrameContainer()
+    for i, frame in zip(frame_ids, frames):
+      downscaled.add(i, _downscale(frame, scale))
+
+    annotations = self.annotator.annotate(downscaled, **kwargs)
+    for i in annotations:
+      if annotations[i]:
+        annotations[i] = _rescale(annotations[i], 1. / scale)
+    return annotations
+
+
+def _downscale(frame, scale):
+  """Downscales the given (color) frame by the given factor, keeping its
+  dtype."""
+  if scale == 1:
+    return frame
+  downscaled = bob.ip.base.scale(frame.astype(numpy.float64), scale)
+  if numpy.issubdtype(frame.dtype, numpy.integer):
+    downscaled = numpy.round(downscaled)
+  return downscaled.astype(frame.dtype)
+
+
+def _rescale(annotations, factor):
+  """Multiplies all points of the given annotations by the given factor."""
+  rescaled = {}
+  for key, value in annotations.items():
+    if isinstance(value, (tuple, list)) and len(value) == 2:
+      rescaled[key] = (value[0] * factor, value[1] * factor)
+    else:
+      rescaled[key] = value
+  return rescaled
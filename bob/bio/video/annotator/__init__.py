@@ -45,6 +45,8 @@ def normalize_annotations(annotations, validator, max_age=-1):
 from .Base import Base
 from .Wrapper import Wrapper
 from .FailSafeVideo import FailSafeVideo
+from .DetectAndTrack import DetectAndTrack
+from .Downscaled import Downscaled
 
 
 # gets sphinx autodoc done right - don't remove it
@@ -70,6 +72,8 @@ __appropriate__(
     Base,
     Wrapper,
     FailSafeVideo,
+    DetectAndTrack,
+    Downscaled,
 )
 
 __all__ = [_ for _ in dir() if not _.startswith('_')]
@@ -12,9 +12,8 @@
 
 from .database import VideoBioFile
 from bob.bio.base.database import ZTBioDatabase
-from bob.bio.video.utils import FrameContainer, FrameSelector
+from bob.bio.video.utils import FrameSelector
 import os
-import bob.io.base
 
 
 class YoutubeBioFile(VideoBioFile):
@@ -35,12 +34,8 @@ class YoutubeBioFile(VideoBioFile):
 
     def load(self, directory=None, extension=None, frame_selector=FrameSelector()):
         if extension in (None, '.jpg'):
-            fc = FrameContainer()
-            files = self.files(directory, extension)
-            for f in frame_selector(files):
-                file_name = os.path.join(self.make_path(directory, ''), f[0])
-                fc.add(os.path.basename(file_name), bob.io.base.load(file_name))
-            return fc
+            # the frame selector loads the selected images and uses their base names as frame ids
+            return frame_selector(self.files(directory, extension))
         else:
             return super(YoutubeBioFile, self).load(directory, extension)
 
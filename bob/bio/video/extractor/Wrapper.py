@@ -17,6 +17,18 @@ class Wrapper (bob.bio.base.extractor.Extractor):
   The ``frame_selector`` can be chosen to select some frames from the frame container.
   By default, all frames from the previous preprocessing step are kept, but fewer frames might be selected in this stage.
 
+  If the ``extractor`` provides a function ``extract_batch(frames) -> features``, the features of several frames are extracted with one call.
+  It gets a stack of frames as a :py:class:`numpy.ndarray` and returns the list (or array) of features, with ``None`` for frames where extraction failed.
+  Up to ``batch_size`` frames are passed at once.
+
+  To train the ``extractor`` with more frames than fit into memory, read the training data with ``lazy_io`` (see :py:class:`bob.bio.video.preprocessor.Wrapper`) and set either ``training_batch_size`` or ``max_training_frames``.
+  If the ``extractor`` provides a function ``train_batches(batches, extractor_file)``, it is called with a generator of mini-batches of at most ``training_batch_size`` frames, see :py:func:`bob.bio.video.training_batches`.
+  Otherwise, at most ``max_training_frames`` frames are sampled at random with bounded memory, see :py:func:`bob.bio.video.reservoir_sample`, and passed to the ``train`` function of the ``extractor``.
+
+  Consecutive frames of a video are often almost identical.
+  If a ``dedup_threshold`` is given, features are extracted only for one representative frame of each group of near-duplicate frames, see :py:func:`bob.bio.video.near_duplicates`.
+  The near-duplicate frames are either dropped, or, if ``copy_duplicates`` is enabled, they get a copy of the features of their representative frame, so that the frame ids stay the same.
+
   **Parameters:**
 
   extractor : str or :py:class:`bob.bio.base.extractor.Extractor` instance
@@ -28,14 +40,58 @@ class Wrapper (bob.bio.base.extractor.Extractor):
   compressed_io : bool
     Use compression to write the resulting features to HDF5 files.
     This is experimental and might cause trouble.
-    Use this flag with care.
+    Use this flag with care, or consider using ``hdf5_compression`` instead.
+
+  hdf5_layout : str
+    The on-disk layout of the written HDF5 files, either ``'groups'`` or ``'dataset'``, see :py:meth:`bob.bio.video.FrameContainer.save`.
+    The ``'dataset'`` layout stores the frames as raw arrays and bypasses the IO functions of the wrapped class.
+    Files written in either layout can be read.
+
+  lazy_io : bool
+    Read the frames of uncompressed files only when they are accessed, see :py:func:`bob.bio.video.load_lazy`.
+    This saves time and memory when the ``frame_selector`` of the next stage keeps only a few frames.
+
+  hdf5_compression : int
+    The gzip compression level between 0 (no compression) and 9, which is used to compress the frames inside the HDF5 files.
+    Requires ``hdf5_layout='dataset'``; single frames can still be read without decompressing the whole file.
+    Cannot be combined with ``compressed_io``, which compresses whole files.
+
+  batch_size : int or ``None``
+    The maximum number of frames passed to the ``extract_batch`` function of the ``extractor``, if it provides one.
+    If ``None``, all selected frames of a video are passed at once.
+
+  training_batch_size : int or ``None``
+    The number of frames in the mini-batches passed to the ``train_batches`` function of the ``extractor``, if it provides one.
+    Mini-batches are not used when the training data is split by client.
+
+  max_training_frames : int or ``None``
+    If given, the ``extractor`` is trained with at most this number of frames (per client, if the training data is split by client), which are sampled with a fixed random seed.
+
+  dedup_threshold : float or ``None``
+    If given, the maximum mean absolute difference between the subsampled pixels of near-duplicate frames.
+
+  copy_duplicates : bool
+    Keep the near-duplicate frames with the features of their representative frame, instead of dropping them.
   """
 
   def __init__(self,
       extractor,
       frame_selector = utils.FrameSelector(selection_style='all'),
-      compressed_io = False
+      compressed_io = False,
+      hdf5_layout = 'groups',
+      lazy_io = False,
+      hdf5_compression = 0,
+      batch_size = None,
+      training_batch_size = None,
+      max_training_frames = None,
+      dedup_threshold = None,
+      copy_duplicates = False
   ):
+    if hdf5_compression and hdf5_layout != 'dataset':
+      raise ValueError("The hdf5_compression requires the 'dataset' hdf5_layout")
+    if hdf5_compression and compressed_io:
+      raise ValueError("The hdf5_compression cannot be used together with compressed_io")
+
     # load extractor configuration
     if isinstance(extractor, six.string_types):
       self.extractor = bob.bio.base.load_resource(extractor, "extractor")
@@ -46,6 +102,14 @@ class Wrapper (bob.bio.base.extractor.Extractor):
 
     self.frame_selector = frame_selector
     self.compressed_io = compressed_io
+    self.hdf5_layout = hdf5_layout
+    self.lazy_io = lazy_io
+    self.hdf5_compression = hdf5_compression
+    self.batch_size = batch_size
+    self.training_batch_size = training_batch_size
+    self.max_training_frames = max_training_frames
+    self.dedup_threshold = dedup_threshold
+    self.copy_duplicates = copy_duplicates
     # register extractor's details
     bob.bio.base.extractor.Extractor.__init__(
         self,
@@ -53,7 +117,15 @@ class Wrapper (bob.bio.base.extractor.Extractor):
         split_training_data_by_client=self.extractor.split_training_data_by_client,
         extractor=extractor,
         frame_selector=frame_selector,
-        compressed_io=compressed_io
+        compressed_io=compressed_io,
+        hdf5_layout=hdf5_layout,
+        lazy_io=lazy_io,
+        hdf5_compression=hdf5_compression,
+        batch_size=batch_size,
+        training_batch_size=training_batch_size,
+        max_training_frames=max_training_frames,
+        dedup_threshold=dedup_threshold,
+        copy_duplicates=copy_duplicates
     )
 
   def _check_feature(self, frames):
@@ -81,9 +153,12 @@ class Wrapper (bob.bio.base.extractor.Extractor):
     self._check_feature(frames)
     # go through the frames and extract the features
     fc = utils.FrameContainer()
-    for index, frame, quality in self.frame_selector(frames):
-      # extract features
-      extracted = self.extractor(frame)
+    selected = self.frame_selector(frames)
+    if self.dedup_threshold is not None:
+      extracted_frames = self._extract_deduplicated(selected)
+    else:
+      extracted_frames = self._extract_frames(selected)
+    for index, extracted, quality in extracted_frames:
       if extracted is not None:
         # add features to new frame container
         fc.add(index, extracted, quality)
@@ -94,8 +169,35 @@ class Wrapper (bob.bio.base.extractor.Extractor):
     return fc
 
 
-  def read_feature(self, filename):
-    """read_feature(filename) -> frames
+  def _extract_frames(self, frames):
+    """Generator that extracts the features of the given frames and yields the 3-tuple (frame_id, extracted, quality) for each frame."""
+    if hasattr(self.extractor, 'extract_batch'):
+      for indices, data, qualities in frames.batches(self.batch_size):
+        for index, extracted, quality in zip(indices, self.extractor.extract_batch(data), qualities):
+          yield index, extracted, quality
+    else:
+      for index, frame, quality in frames:
+        yield index, self.extractor(frame), quality
+
+
+  def _extract_deduplicated(self, frames):
+    """Generator like :py:meth:`_extract_frames`, which extracts features only for the representatives of near-duplicate frames."""
+    representatives = utils.near_duplicates(frames, self.dedup_threshold)
+    unique = sorted(set(representatives))
+    selected = utils.FrameContainer()
+    for i in unique:
+      selected.add(*frames[i])
+    features = dict((i, extracted) for i, (_, extracted, _) in zip(unique, self._extract_frames(selected)))
+    for i, (index, _, quality) in enumerate(frames):
+      if representatives[i] == i:
+        yield index, features[i], quality
+      elif self.copy_duplicates:
+        # the near-duplicate gets the features of its representative frame
+        yield index, features[representatives[i]], quality
+
+
+  def read_feature(self, filename, frame_selector = None):
+    """read_feature(filename, frame_selector = None) -> frames
 
     Reads the extracted data from file and returns them in a frame container.
     The extractors ``read_feature`` function is used to read the data for each frame.
@@ -105,15 +207,20 @@ class Wrapper (bob.bio.base.extractor.Extractor):
     filename : str
       The name of the extracted data file.
 
+    frame_selector : :py:class:`bob.bio.video.FrameSelector` or ``None``
+      If given, only the frames selected by this frame selector are read from file.
+
     **Returns:**
 
     frames : :py:class:`bob.bio.video.FrameContainer`
       The read frames, stored in a frame container.
     """
     if self.compressed_io:
-      return utils.load_compressed(filename, self.extractor.read_feature)
+      return utils.load_compressed(filename, self.extractor.read_feature, frame_selector)
+    elif self.lazy_io and frame_selector is None:
+      return utils.load_lazy(filename, self.extractor.read_feature)
     else:
-      return utils.FrameContainer(bob.io.base.HDF5File(filename), self.extractor.read_feature)
+      return utils.FrameContainer(bob.io.base.HDF5File(filename), self.extractor.read_feature, frame_selector)
 
 
   def write_feature(self, frames, filename):
@@ -131,9 +238,9 @@ class Wrapper (bob.bio.base.extractor.Extractor):
     """
     self._check_feature(frames)
     if self.compressed_io:
-      return utils.save_compressed(frames, filename, self.extractor.write_feature)
+      return utils.save_compressed(frames, filename, self.extractor.write_feature, layout=self.hdf5_layout)
     else:
-      frames.save(bob.io.base.HDF5File(filename, 'w'), self.extractor.write_feature)
+      frames.save(bob.io.base.HDF5File(filename, 'w'), self.extractor.write_feature, self.hdf5_layout, self.hdf5_compression)
 
 
   def train(self, training_frames, extractor_file):
@@ -155,12 +262,21 @@ class Wrapper (bob.bio.base.extractor.Extractor):
     """
     if self.split_training_data_by_client:
       [self._check_feature(frames) for client_frames in training_frames for frames in client_frames]
-      features = [[frame[1] for frames in client_frames for frame in self.frame_selector(frames)] for client_frames in training_frames]
+      features = [self._training_features(client_frames) for client_frames in training_frames]
     else:
       [self._check_feature(frames) for frames in training_frames]
-      features = [frame[1] for frames in training_frames for frame in self.frame_selector(frames)]
+      if self.training_batch_size and hasattr(self.extractor, 'train_batches'):
+        # stream the frames in mini-batches
+        return self.extractor.train_batches(utils.training_batches(training_frames, self.frame_selector, self.training_batch_size), extractor_file)
+      features = self._training_features(training_frames)
     self.extractor.train(features, extractor_file)
 
+  def _training_features(self, training_frames):
+    """Returns the selected frames of the given frame containers, sampling at most ``max_training_frames``."""
+    if self.max_training_frames:
+      return utils.reservoir_sample(training_frames, self.frame_selector, self.max_training_frames, seed = 0)
+    return [frame[1] for frames in training_frames for frame in self.frame_selector(frames)]
+
 
   def load(self, extractor_file):
     """Loads the trained extractor from file.
@@ -3,11 +3,60 @@
 
 import bob.bio.base
 import bob.io.base
+import collections
+import copy
+import multiprocessing
+import multiprocessing.pool
+import numpy
+import re
 import six
+import threading
 
 from .. import utils
 
 
+# the preprocessor and quality function used by the current worker of a pool
+_worker = threading.local()
+
+def _init_worker(preprocessor, quality_function, copy_preprocessor):
+    """Initializes a worker of the pool, see :py:meth:`Wrapper._preprocess_parallel`."""
+    # threads get their own copy, so that they do not share the state (e.g. the quality) of the preprocessor
+    _worker.preprocessor = copy.deepcopy(preprocessor) if copy_preprocessor else preprocessor
+    _worker.quality_function = quality_function
+
+def _preprocess_frame(preprocessor, quality_function, index, frame, annots):
+    """Preprocesses a single frame and returns the 3-tuple (frame_id, preprocessed, quality), where ``preprocessed`` is ``None`` if preprocessing failed."""
+    # preprocess image (by default: detect a face)
+    preprocessed = preprocessor(frame, annots)
+    quality = None
+    if preprocessed is not None:
+        # compute the quality of the detection
+        if quality_function is not None:
+            quality = quality_function(preprocessed)
+        elif hasattr(preprocessor, 'quality'):
+            quality = preprocessor.quality
+    return index, preprocessed, quality
+
+def _coarse_to_fine(count):
+    """Returns the indices of ``count`` frames, ordered from coarse to fine, e.g., ``[0, 4, 2, 6, 1, 3, 5, 7]`` for 8 frames."""
+    step = 1
+    while step < count:
+        step *= 2
+    order = []
+    visited = set()
+    while step >= 1:
+        for i in range(0, count, step):
+            if i not in visited:
+                visited.add(i)
+                order.append(i)
+        step //= 2
+    return order
+
+def _preprocess_frame_in_worker(args):
+    """Preprocesses a single frame with the preprocessor of the current worker."""
+    return _preprocess_frame(_worker.preprocessor, _worker.quality_function, *args)
+
+
 class Wrapper(bob.bio.base.preprocessor.Preprocessor):
     """Wrapper class to run image preprocessing algorithms on video data.
 
@@ -25,6 +74,13 @@ class Wrapper(bob.bio.base.preprocessor.Preprocessor):
     If no ``quality_function`` is given, the quality is based on the face detector, or simply left as ``None``.
     So far, the quality of the frames are not used, but it is foreseen to select frames based on quality.
 
+    If the ``preprocessor`` provides a function ``preprocess_batch(frames, annotations) -> (preprocessed, qualities)``, several frames are preprocessed with one call.
+    It gets a stack of frames as a :py:class:`numpy.ndarray` together with the list of annotations for these frames (with ``None`` for missing annotations), and returns the list of preprocessed frames (with ``None`` for failures) and their qualities.
+    Up to ``batch_size`` frames are passed at once.
+
+    Otherwise, the frames of a video can be preprocessed in parallel by a pool of ``number_of_workers`` threads or processes, see ``parallel``.
+    Each thread works on a deep copy of the ``preprocessor``, while for processes the ``preprocessor`` is pickled; hence, it needs to support this.
+
     **Parameters:**
 
     preprocessor : str or :py:class:`bob.bio.base.preprocessor.Preprocessor` instance
@@ -41,7 +97,66 @@ class Wrapper(bob.bio.base.preprocessor.Preprocessor):
     compressed_io : bool
       Use compression to write the resulting preprocessed HDF5 files.
       This is experimental and might cause trouble.
-      Use this flag with care.
+      Use this flag with care, or consider using ``hdf5_compression`` instead.
+
+    hdf5_layout : str
+      The on-disk layout of the written HDF5 files, either ``'groups'`` or ``'dataset'``, see :py:meth:`bob.bio.video.FrameContainer.save`.
+      The ``'dataset'`` layout stores the frames as raw arrays and bypasses the IO functions of the wrapped class.
+      Files written in either layout can be read.
+
+    lazy_io : bool
+      Read the frames of uncompressed files only when they are accessed, see :py:func:`bob.bio.video.load_lazy`.
+      This saves time and memory when the ``frame_selector`` of the next stage keeps only a few frames.
+
+    hdf5_compression : int
+      The gzip compression level between 0 (no compression) and 9, which is used to compress the frames inside the HDF5 files.
+      Requires ``hdf5_layout='dataset'``; single frames can still be read without decompressing the whole file.
+      Cannot be combined with ``compressed_io``, which compresses whole files.
+
+    batch_size : int or ``None``
+      The maximum number of frames passed to the ``preprocess_batch`` function of the ``preprocessor``, if it provides one.
+      If ``None``, all frames of a video are passed at once.
+
+    parallel : str or ``None``
+      If ``'threads'`` or ``'processes'``, the frames of one video are preprocessed in parallel by a pool of the given type.
+      The frames are returned in their original order.
+      The pool is created at the first use and reused for all following videos; call :py:meth:`close` to stop its workers.
+      The workers get the ``preprocessor`` when the pool is created, so later changes of the ``preprocessor`` are not seen by them.
+
+    number_of_workers : int or ``None``
+      The number of threads or processes of the pool; if ``None``, the number of CPUs is used.
+
+    annotator : :py:class:`bob.bio.video.annotator.Base` or ``None``
+      A video annotator that computes the annotations of the frames, for which no annotations are given.
+      For example, :py:class:`bob.bio.video.annotator.DetectAndTrack` runs a face detector on a few keyframes only, and tracks the face in between.
+      The ``preprocessor`` needs to be able to handle the annotations returned by the annotator.
+      With ``target_frames``, the annotator is run on each visited frame separately, so that no frames are annotated after preprocessing stops; trackers such as :py:class:`bob.bio.video.annotator.DetectAndTrack` then detect the face in every visited frame.
+
+    target_frames : int or ``None``
+      If given, preprocessing of a video stops as soon as ``target_frames`` frames with a quality of at least ``min_quality`` are preprocessed.
+      The frames are visited in the given ``frame_order``, and the preprocessed frames are returned in temporal order.
+      The frames are preprocessed one by one, i.e., ``batch_size`` and ``parallel`` are not used in this case.
+
+    min_quality : float or ``None``
+      The minimum quality of a frame to count for the ``target_frames``; if ``None``, all preprocessed frames count.
+
+    frame_order : str
+      The order in which frames are visited when ``target_frames`` is given.
+      ``'sequential'`` visits the frames from the beginning, while ``'coarse-to-fine'`` visits frames spread over the whole video first, and fills the gaps afterward.
+
+    queue_size : int
+      If positive, :py:meth:`preprocess_and_write` overlaps reading, preprocessing and writing of the frames.
+      Up to ``queue_size`` frames are read in advance by a background thread, and up to ``queue_size`` preprocessed frames wait to be written by another background thread.
+
+    frame_cache : :py:class:`bob.bio.video.FrameCache` or ``None``
+      If given, the preprocessed frames are looked up in and stored to this cache.
+      Frames are identified by their content, their annotations and the configuration of the ``preprocessor`` and the ``quality_function``, so the preprocessor is only run on frames that have not been preprocessed before with the same configuration.
+      The configuration is given by ``cache_config``, and the cached frames are read and written using the IO functions of the ``preprocessor``.
+
+    cache_config : str or ``None``
+      The configuration of the ``preprocessor`` and the ``quality_function``, which is part of the keys of the ``frame_cache``; change it whenever the preprocessing changes.
+      If ``None``, it is taken from ``str(preprocessor)`` and the name of the ``quality_function``.
+      As these cannot identify preprocessors that do not report their parameters, lambda functions or parameters that are printed with their memory address, a ``cache_config`` is required in these cases.
 
     read_original_data: callable or ``None``
        Function that loads the raw data.
@@ -55,13 +170,37 @@ class Wrapper(bob.bio.base.preprocessor.Preprocessor):
                  frame_selector=utils.FrameSelector(),
                  quality_function=None,
                  compressed_io=False,
-                 read_original_data=None
+                 read_original_data=None,
+                 hdf5_layout='groups',
+                 lazy_io=False,
+                 hdf5_compression=0,
+                 batch_size=None,
+                 parallel=None,
+                 number_of_workers=None,
+                 annotator=None,
+                 target_frames=None,
+                 min_quality=None,
+                 frame_order='sequential',
+                 queue_size=0,
+                 frame_cache=None,
+                 cache_config=None
                  ):
 
         def _read_video_data(biofile, directory, extension):
           """Read video data using the frame_selector of this object"""
           return biofile.load(directory, extension, frame_selector)
 
+        if hdf5_compression and hdf5_layout != 'dataset':
+            raise ValueError("The hdf5_compression requires the 'dataset' hdf5_layout")
+        if hdf5_compression and compressed_io:
+            raise ValueError("The hdf5_compression cannot be used together with compressed_io")
+
+        if parallel not in (None, 'threads', 'processes'):
+            raise ValueError("Unknown parallel mode '%s', choose one of (None, 'threads', 'processes')" % parallel)
+
+        if frame_order not in ('sequential', 'coarse-to-fine'):
+            raise ValueError("Unknown frame order '%s', choose one of ('sequential', 'coarse-to-fine')" % frame_order)
+
         if read_original_data is None:
           read_original_data = _read_video_data
 
@@ -79,11 +218,44 @@ class Wrapper(bob.bio.base.preprocessor.Preprocessor):
             preprocessor=preprocessor,
             frame_selector=frame_selector,
             compressed_io=compressed_io,
-            read_original_data=read_original_data
+            read_original_data=read_original_data,
+            hdf5_layout=hdf5_layout,
+            lazy_io=lazy_io,
+            hdf5_compression=hdf5_compression,
+            batch_size=batch_size,
+            parallel=parallel,
+            number_of_workers=number_of_workers,
+            annotator=annotator,
+            target_frames=target_frames,
+            min_quality=min_quality,
+            frame_order=frame_order,
+            queue_size=queue_size,
+            frame_cache=frame_cache,
+            cache_config=cache_config
         )
 
         self.quality_function = quality_function
         self.compressed_io = compressed_io
+        self.hdf5_layout = hdf5_layout
+        self.lazy_io = lazy_io
+        self.hdf5_compression = hdf5_compression
+        self.batch_size = batch_size
+        self.parallel = parallel
+        self.number_of_workers = number_of_workers
+        self.annotator = annotator
+        self.target_frames = target_frames
+        self.min_quality = min_quality
+        self.frame_order = frame_order
+        self.queue_size = queue_size
+        self.frame_cache = frame_cache
+        # the configuration that is part of the keys of the frame cache
+        if frame_cache is not None and cache_config is None:
+            cache_config = "%s %s" % (self.preprocessor, getattr(quality_function, '__name__', quality_function))
+            if re.search(r"\(\)|<lambda>| at 0x[0-9a-fA-F]+", cache_config):
+                raise ValueError("The configuration '%s' does not identify the preprocessing; please give a cache_config for the frame_cache" % cache_config)
+        self.cache_config = cache_config
+        # the pool of the parallel preprocessing, which is created at first usage
+        self._pool = None
 
     def _check_data(self, frames):
         """Checks if the given video is in the desired format."""
@@ -117,34 +289,251 @@ class Wrapper(bob.bio.base.preprocessor.Preprocessor):
           A frame container that contains the preprocessed frames.
         """
 
+        annotations = self._complete_annotations(frames, annotations)
         fc = utils.FrameContainer()
+        for index, preprocessed, quality in self._preprocess_frames(frames, annotations):
+            # add image to frame container
+            fc.add(index, preprocessed, quality)
 
-        for index, frame, _ in frames:
+        if not len(fc):
+          return None
+
+        return fc
+
+    def _complete_annotations(self, frames, annotations):
+        """Computes the annotations of the frames, for which none are given, using the ``annotator``.
+        With ``target_frames``, the frames are annotated when they are visited, see :py:meth:`_preprocess_until_target`."""
+        if self.annotator is None or self.target_frames is not None:
+            return annotations
+        self._check_data(frames)
+        if annotations is not None and all(index in annotations for index, _, _ in frames):
+            return annotations
+        computed = self.annotator.annotate(frames)
+        if annotations is not None:
+            # given annotations take precedence
+            computed.update(annotations)
+        return computed
+
+    def _preprocess_frames(self, frames, annotations):
+        """Generator that preprocesses the given frames one by one and yields the 3-tuple (frame_id, preprocessed, quality) for each frame, for which preprocessing succeeded."""
+        if self.target_frames is not None:
+            for result in self._preprocess_until_target(frames, annotations):
+                yield result
+            return
+
+        if self.frame_cache is not None:
+            for result in self._preprocess_cached(frames, annotations):
+                yield result
+            return
+
+        for result in self._preprocess_uncached(frames, annotations):
+            yield result
+
+    def _preprocess_uncached(self, frames, annotations):
+        """Generator like :py:meth:`_preprocess_frames`, which does not use the ``target_frames`` and the ``frame_cache``."""
+        if hasattr(self.preprocessor, 'preprocess_batch'):
+            for result in self._preprocess_batches(frames, annotations):
+                yield result
+            return
+
+        if self.parallel is not None:
+            for result in self._preprocess_parallel(frames, annotations):
+                yield result
+            return
 
+        for index, frame, _ in frames:
             # if annotations are given, and if particular frame annotations are not missing we take them:
             annots = annotations[index] if annotations is not None and index in annotations else None
+            index, preprocessed, quality = _preprocess_frame(self.preprocessor, self.quality_function, index, frame, annots)
+            if preprocessed is not None:
+                yield index, preprocessed, quality
 
-            # preprocess image (by default: detect a face)
-            preprocessed = self.preprocessor(frame, annots)
+    def _preprocess_until_target(self, frames, annotations):
+        """Generator like :py:meth:`_preprocess_frames`, which stops preprocessing when ``target_frames`` good frames are found."""
+        self._check_data(frames)
+        if self.frame_order == 'coarse-to-fine':
+            order = _coarse_to_fine(len(frames))
+        else:
+            order = range(len(frames))
+
+        results = {}
+        good = 0
+        for i in order:
+            index, frame, _ = frames[i]
+            annots = annotations[index] if annotations is not None and index in annotations else None
+            if self.annotator is not None and (annotations is None or index not in annotations):
+                # only the visited frames are annotated
+                annots = self.annotator.annotate(frames[i:i+1]).get(index)
+            if self.frame_cache is not None:
+                index, preprocessed, quality = self._preprocess_frame_cached(index, frame, annots)
+            else:
+                index, preprocessed, quality = _preprocess_frame(self.preprocessor, self.quality_function, index, frame, annots)
+            if preprocessed is None:
+                continue
+            results[i] = (index, preprocessed, quality)
+            if self.min_quality is None or (quality is not None and quality >= self.min_quality):
+                good += 1
+                if good >= self.target_frames:
+                    break
+
+        # return the frames in temporal order
+        for i in sorted(results):
+            yield results[i]
+
+    def _preprocess_frame_cached(self, index, frame, annots):
+        """Preprocesses a single frame like :py:func:`_preprocess_frame`, but looks it up in and stores it to the ``frame_cache``."""
+        key = self.frame_cache.key(frame, annots, self.cache_config)
+        cached = self.frame_cache.get(key, self.preprocessor.read_data)
+        if cached is not None:
+            return (index,) + cached
+        index, preprocessed, quality = _preprocess_frame(self.preprocessor, self.quality_function, index, frame, annots)
+        self.frame_cache.put(key, preprocessed, quality, self.preprocessor.write_data)
+        return index, preprocessed, quality
+
+    def _preprocess_cached(self, frames, annotations):
+        """Generator like :py:meth:`_preprocess_frames`, which takes the frames from the ``frame_cache`` when possible.
+        The remaining frames are preprocessed by :py:meth:`_preprocess_uncached`, i.e., in batches or in parallel, and stored to the cache."""
+        # the frames in their original order as 3-tuples (frame_id, key, cached), where cached is None for frames that need preprocessing
+        pending = collections.deque()
+
+        def _missing_frames():
+            for index, frame, quality in frames:
+                annots = annotations[index] if annotations is not None and index in annotations else None
+                key = self.frame_cache.key(frame, annots, self.cache_config)
+                cached = self.frame_cache.get(key, self.preprocessor.read_data)
+                pending.append((index, key, cached))
+                if cached is None:
+                    yield index, frame, quality
+
+        def _finish(index, key, cached):
+            # returns the result of a pending frame, which is not preprocessed now;
+            # frames that needed preprocessing, but for which no result was returned, have failed
+            if cached is None:
+                self.frame_cache.put(key, None, None, self.preprocessor.write_data)
+            elif cached[0] is not None:
+                return (index,) + cached
+            return None
+
+        for index, preprocessed, quality in self._preprocess_uncached(_missing_frames(), annotations):
+            # the results are returned in the original order
+            while True:
+                pending_index, key, cached = pending.popleft()
+                if cached is None and pending_index == index:
+                    break
+                result = _finish(pending_index, key, cached)
+                if result is not None:
+                    yield result
+            self.frame_cache.put(key, preprocessed, quality, self.preprocessor.write_data)
+            yield index, preprocessed, quality
+
+        while pending:
+            result = _finish(*pending.popleft())
+            if result is not None:
+                yield result
+
+    def _preprocess_parallel(self, frames, annotations):
+        """Generator like :py:meth:`_preprocess_frames`, which distributes the frames to a pool of threads or processes."""
+        tasks = [(index, frame, annotations[index] if annotations is not None and index in annotations else None) for index, frame, _ in frames]
+        if self._pool is None:
+            number_of_workers = self.number_of_workers or multiprocessing.cpu_count()
+            initargs = (self.preprocessor, self.quality_function, self.parallel == 'threads')
+            if self.parallel == 'threads':
+                self._pool = multiprocessing.pool.ThreadPool(number_of_workers, _init_worker, initargs)
+            else:
+                self._pool = multiprocessing.Pool(number_of_workers, _init_worker, initargs)
+        # imap keeps the order of the frames
+        for index, preprocessed, quality in self._pool.imap(_preprocess_frame_in_worker, tasks):
             if preprocessed is not None:
-                # compute the quality of the detection
+                yield index, preprocessed, quality
+
+    def close(self):
+        """Stops the workers of the pool used for parallel preprocessing, if any.
+        A new pool is created when frames are preprocessed in parallel again."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _preprocess_batches(self, frames, annotations):
+        """Generator like :py:meth:`_preprocess_frames`, which passes batches of frames to the ``preprocess_batch`` function of the preprocessor."""
+        batch = []
+        for frame in frames:
+            batch.append(frame)
+            if self.batch_size and len(batch) == self.batch_size:
+                for result in self._preprocess_batch(batch, annotations):
+                    yield result
+                batch = []
+        if batch:
+            for result in self._preprocess_batch(batch, annotations):
+                yield result
+
+    def _preprocess_batch(self, batch, annotations):
+        """Preprocesses the given list of frames with one call to the ``preprocess_batch`` function of the preprocessor."""
+        indices = [index for index, _, _ in batch]
+        annots = [annotations[index] if annotations is not None and index in annotations else None for index in indices]
+        preprocessed, qualities = self.preprocessor.preprocess_batch(numpy.array([frame for _, frame, _ in batch]), annots)
+        for index, data, quality in zip(indices, preprocessed, qualities):
+            if data is not None:
                 if self.quality_function is not None:
-                    quality = self.quality_function(preprocessed)
-                elif hasattr(self.preprocessor, 'quality'):
-                    quality = self.preprocessor.quality
-                else:
-                    quality = None
-                # add image to frame container
-                fc.add(index, preprocessed, quality)
+                    quality = self.quality_function(data)
+                yield index, data, quality
 
-        if not len(fc):
-          return None
+    def preprocess_and_write(self, frames, filename, annotations=None, flush_interval=0):
+        """preprocess_and_write(frames, filename, annotations=None, flush_interval=0) -> count
 
-        return fc
+        Preprocesses the given frames like :py:meth:`__call__` does, but writes each preprocessed frame to file immediately.
+
+        Hence, the preprocessed frames are never kept in memory together, which allows to preprocess very long videos in constant memory.
+        The written file can be read with :py:meth:`read_data`.
+        With ``compressed_io``, the frames are written to a temporary file, which is compressed when all frames are written.
+
+        Together with :py:meth:`bob.bio.video.FrameSelector.iterate`, the selected frames of a video file are decoded only when they are needed:
+
+        .. code-block:: py
+
+           preprocessor.preprocess_and_write(frame_selector.iterate(video_file), filename)
+
+        If a ``queue_size`` was given in the constructor, frames that are not in a frame container are read by a background thread, see :py:func:`bob.bio.video.prefetch`, and the preprocessed frames are written by another background thread, see :py:class:`bob.bio.video.FrameWriter`.
+        Hence, decoding, preprocessing and writing of the frames overlap.
+
+        **Parameters:**
+
+        frames : :py:class:`bob.bio.video.FrameContainer` or iterable
+          The pre-selected frames, or any iterable of 3-tuples (frame_id, frame, quality).
+          If an ``annotator`` is used, a frame container is required.
+
+        filename : str
+          The name of the preprocessed data file to write.
+
+        annotations : dict or ``None``
+          The annotations for the frames, if any, see :py:meth:`__call__`.
 
+        flush_interval : int
+          If positive, the file is flushed to disk every ``flush_interval`` frames.
 
-    def read_data(self, filename):
-        """read_data(filename) -> frames
+        **Returns:**
+
+        count : int
+          The number of preprocessed frames that were written.
+        """
+        annotations = self._complete_annotations(frames, annotations)
+        if self.queue_size > 0 and not isinstance(frames, utils.FrameContainer):
+            frames = utils.prefetch(frames, self.queue_size)
+        if self.compressed_io:
+            # the frames are written to a temporary file, which is compressed at the end
+            hdf5 = bob.bio.base.open_compressed(filename, 'w')
+        else:
+            hdf5 = bob.io.base.HDF5File(filename, 'w')
+        with utils.FrameWriter(hdf5, self.preprocessor.write_data, self.hdf5_layout, self.hdf5_compression, flush_interval, self.queue_size) as writer:
+            for index, preprocessed, quality in self._preprocess_frames(frames, annotations):
+                writer.add(index, preprocessed, quality)
+        if self.compressed_io:
+            bob.bio.base.close_compressed(filename, hdf5, create_link=True)
+        del hdf5
+        return len(writer)
+
+    def read_data(self, filename, frame_selector=None):
+        """read_data(filename, frame_selector=None) -> frames
 
         Reads the preprocessed data from file and returns them in a frame container.
         The preprocessors ``read_data`` function is used to read the data for each frame.
@@ -154,15 +543,20 @@ class Wrapper(bob.bio.base.preprocessor.Preprocessor):
         filename : str
           The name of the preprocessed data file.
 
+        frame_selector : :py:class:`bob.bio.video.FrameSelector` or ``None``
+          If given, only the frames selected by this frame selector are read from file.
+
         **Returns:**
 
         frames : :py:class:`bob.bio.video.FrameContainer`
           The read frames, stored in a frame container.
         """
         if self.compressed_io:
-            return utils.load_compressed(filename, self.preprocessor.read_data)
+            return utils.load_compressed(filename, self.preprocessor.read_data, frame_selector)
+        elif self.lazy_io and frame_selector is None:
+            return utils.load_lazy(filename, self.preprocessor.read_data)
         else:
-            return utils.FrameContainer(bob.io.base.HDF5File(filename), self.preprocessor.read_data)
+            return utils.FrameContainer(bob.io.base.HDF5File(filename), self.preprocessor.read_data, frame_selector)
 
     def write_data(self, frames, filename):
         """Writes the preprocessed data to file.
@@ -180,6 +574,6 @@ class Wrapper(bob.bio.base.preprocessor.Preprocessor):
         self._check_data(frames)
 
         if self.compressed_io:
-            return utils.save_compressed(frames, filename, self.preprocessor.write_data)
+            return utils.save_compressed(frames, filename, self.preprocessor.write_data, layout=self.hdf5_layout)
         else:
-            frames.save(bob.io.base.HDF5File(filename, 'w'), self.preprocessor.write_data)
+            frames.save(bob.io.base.HDF5File(filename, 'w'), self.preprocessor.write_data, self.hdf5_layout, self.hdf5_compression)
@@ -11,6 +11,7 @@ import bob.io.base.test_utils
 import bob.io.image
 import bob.io.video
 
+import nose.tools
 from nose.plugins.skip import SkipTest
 import pkg_resources
 
@@ -73,3 +74,249 @@ def test_algorithm():
   score = algorithm.score(model, projected)
   ref = 751.924863
   assert abs(score - ref) < 1e-4, "The score %f is not close to %f" % (score, ref)
+
+
+class LinearProjection(bob.bio.base.algorithm.Algorithm):
+  """Test algorithm, which projects features with a fixed matrix."""
+  def __init__(self):
+    super(LinearProjection, self).__init__(performs_projection=True)
+    self.matrix = numpy.arange(12.).reshape(4, 3)
+  def project(self, feature):
+    return numpy.dot(feature, self.matrix)
+  def score(self, model, probe):
+    return -numpy.linalg.norm(model - probe)
+
+
+class BatchLinearProjection(LinearProjection):
+  """Test algorithm, which projects stacks of features with one matrix multiplication."""
+  def __init__(self):
+    super(BatchLinearProjection, self).__init__()
+    self.calls = 0
+  def project_batch(self, features):
+    self.calls += 1
+    return numpy.dot(features, self.matrix)
+
+
+def test_batch():
+  features = bob.bio.video.FrameContainer()
+  for i in range(10):
+    features.add(i, numpy.random.rand(4), i / 10.)
+  reference = bob.bio.video.algorithm.Wrapper(LinearProjection(), compressed_io=False).project(features)
+
+  algorithm = bob.bio.video.algorithm.Wrapper(BatchLinearProjection(), compressed_io=False)
+  projected = algorithm.project(features)
+  assert algorithm.algorithm.calls == 1
+  assert projected.is_similar_to(reference)
+  assert [f[0] for f in projected] == [str(i) for i in range(10)]
+  assert [f[2] for f in projected] == [i / 10. for i in range(10)]
+
+  # empty frame containers are not projected, like without batches
+  algorithm = bob.bio.video.algorithm.Wrapper(BatchLinearProjection(), compressed_io=False)
+  projected = algorithm.project(bob.bio.video.FrameContainer())
+  assert algorithm.algorithm.calls == 0
+  assert len(projected) == 0
+
+
+class ReadCountingProjection(LinearProjection):
+  """Test algorithm, which counts the frames read from file."""
+  def __init__(self):
+    super(ReadCountingProjection, self).__init__()
+    self.reads = 0
+  def read_feature(self, feature_file):
+    self.reads += 1
+    return super(ReadCountingProjection, self).read_feature(feature_file)
+
+
+def test_io():
+  features = bob.bio.video.FrameContainer()
+  for i in range(6):
+    features.add(i, numpy.random.rand(3), i / 6.)
+  frame_selector = bob.bio.video.FrameSelector(selection_style='step', step_size=2, max_number_of_frames=3)
+
+  filename = bob.io.base.test_utils.temporary_filename()
+  try:
+    for kwargs in ({}, {'hdf5_layout': 'dataset'}, {'lazy_io': True}, {'hdf5_layout': 'dataset', 'lazy_io': True}, {'hdf5_layout': 'dataset', 'hdf5_compression': 9}):
+      algorithm = bob.bio.video.algorithm.Wrapper(ReadCountingProjection(), compressed_io=False, **kwargs)
+      algorithm.write_feature(features, filename)
+      read = algorithm.read_feature(filename)
+      # lazily loaded frames are read when they are accessed
+      groups = kwargs.get('hdf5_layout', 'groups') == 'groups'
+      assert algorithm.algorithm.reads == (6 if groups and not kwargs.get('lazy_io') else 0)
+      assert read.is_similar_to(features)
+      assert [f[2] for f in read] == [f[2] for f in features]
+
+      # only the selected frames are read
+      reads = algorithm.algorithm.reads
+      selected = algorithm.read_feature(filename, frame_selector)
+      assert [f[0] for f in selected] == ['1', '3', '5']
+      assert selected.is_similar_to(frame_selector(features))
+      assert algorithm.algorithm.reads - reads == (3 if groups else 0)
+  finally:
+    if os.path.exists(filename):
+      os.remove(filename)
+
+  # the compression inside the file requires the dataset layout, and cannot be combined with compressing the whole file
+  nose.tools.assert_raises(ValueError, bob.bio.video.algorithm.Wrapper, LinearProjection(), hdf5_compression=9)
+  nose.tools.assert_raises(ValueError, bob.bio.video.algorithm.Wrapper, LinearProjection(), compressed_io=True, hdf5_layout='dataset', hdf5_compression=9)
+
+
+def test_frame_scorer():
+  numpy.random.seed(7)
+  model = numpy.random.rand(3, 4)
+  probe = bob.bio.video.FrameContainer()
+  for i in range(5):
+    probe.add(i, numpy.random.rand(4), (i + 1) / 5.)
+
+  # the scores computed frame by frame
+  cosine = numpy.array([[numpy.dot(m, p[1]) / numpy.linalg.norm(m) / numpy.linalg.norm(p[1]) for p in probe] for m in model])
+  euclidean = numpy.array([[-numpy.linalg.norm(m - p[1]) for p in probe] for m in model])
+  weights = numpy.arange(1, 6) / 5.
+
+  for frame_scorer, scores in (('cosine', cosine), ('euclidean', euclidean)):
+    for fusion, expected in (
+        ('max', scores.max()),
+        ('mean', scores.mean()),
+        ('median', numpy.median(scores)),
+        ('top-k', numpy.sort(scores.ravel())[-4:].mean()),
+        ('quality-weighted', numpy.dot(scores.mean(axis=0), weights) / weights.sum()),
+    ):
+      algorithm = bob.bio.video.algorithm.Wrapper(LinearProjection(), compressed_io=False, frame_scorer=frame_scorer, score_fusion=fusion, fusion_top_k=4)
+      score = algorithm.score(model, probe)
+      assert abs(score - expected) < 1e-8, (frame_scorer, fusion, score, expected)
+
+  # several probes are scored together
+  algorithm = bob.bio.video.algorithm.Wrapper(LinearProjection(), compressed_io=False, frame_scorer='cosine', score_fusion='max')
+  assert abs(algorithm.score_for_multiple_probes(model, [probe[:2], probe[2:]]) - cosine.max()) < 1e-8
+
+  # invalid scorers and fusions are detected
+  nose.tools.assert_raises(ValueError, bob.bio.video.algorithm.Wrapper, LinearProjection(), frame_scorer='unknown')
+  nose.tools.assert_raises(ValueError, bob.bio.video.algorithm.Wrapper, LinearProjection(), score_fusion='unknown')
+
+
+def test_score_models():
+  numpy.random.seed(11)
+  models = [numpy.random.rand(n, 4) for n in (1, 3, 2, 5)]
+  probe = bob.bio.video.FrameContainer()
+  for i in range(6):
+    probe.add(i, numpy.random.rand(4), (i + 1) / 6.)
+
+  # the batched scores are identical to the scores of the single models
+  for frame_scorer in ('cosine', 'euclidean', 'dot'):
+    for fusion in ('max', 'mean', 'median', 'top-k', 'quality-weighted'):
+      algorithm = bob.bio.video.algorithm.Wrapper(LinearProjection(), compressed_io=False, frame_scorer=frame_scorer, score_fusion=fusion, fusion_top_k=3)
+      scores = algorithm.score_models(models, probe)
+      expected = [algorithm.score(model, probe) for model in models]
+      assert numpy.allclose(scores, expected), (frame_scorer, fusion, scores, expected)
+      assert abs(algorithm.score_for_multiple_models(models, probe) - numpy.mean(expected)) < 1e-8
+
+  # without frame scorer, the wrapped algorithm is used for each model
+  algorithm = bob.bio.video.algorithm.Wrapper(LinearProjection(), compressed_io=False)
+  models = [numpy.random.rand(4) for _ in range(3)]
+  assert numpy.allclose(algorithm.score_models(models, probe), [algorithm.score(model, probe) for model in models])
+
+
+class ListEnroller(LinearProjection):
+  """Test algorithm, which enrolls the list of features as the model."""
+  def enroll(self, enroll_features):
+    return numpy.array(enroll_features)
+
+
+def test_enroll_pooling():
+  # two clusters of features in two videos
+  videos = []
+  for v in range(2):
+    frames = bob.bio.video.FrameContainer()
+    for i in range(6):
+      frames.add(i, numpy.array([i % 2 * 10., v + i / 10.]), i % 2 + 1.)
+    videos.append(frames)
+  features = numpy.array([f[1] for frames in videos for f in frames])
+
+  algorithm = bob.bio.video.algorithm.Wrapper(ListEnroller(), compressed_io=False)
+  assert algorithm.enroll(videos).shape == (12, 2)
+
+  algorithm = bob.bio.video.algorithm.Wrapper(ListEnroller(), compressed_io=False, enroll_pooling='mean')
+  assert numpy.allclose(algorithm.enroll(videos), [features.mean(axis=0)])
+
+  algorithm = bob.bio.video.algorithm.Wrapper(ListEnroller(), compressed_io=False, enroll_pooling='quality-weighted')
+  weights = numpy.array([f[2] for frames in videos for f in frames])
+  assert numpy.allclose(algorithm.enroll(videos), [numpy.dot(weights, features) / weights.sum()])
+
+  algorithm = bob.bio.video.algorithm.Wrapper(ListEnroller(), compressed_io=False, enroll_pooling='k-means', pooled_frames=2)
+  model = algorithm.enroll(videos)
+  assert numpy.allclose(sorted(model[:, 0]), [0., 10.])
+
+  algorithm = bob.bio.video.algorithm.Wrapper(ListEnroller(), compressed_io=False, enroll_pooling='k-medoids', pooled_frames=2)
+  model = algorithm.enroll(videos)
+  assert len(model) == 2
+  assert all(any(numpy.allclose(m, f) for f in features) for m in model)
+
+  nose.tools.assert_raises(ValueError, bob.bio.video.algorithm.Wrapper, ListEnroller(), enroll_pooling='unknown')
+
+
+def test_caches():
+  model_file = bob.io.base.test_utils.temporary_filename()
+  probe_file = bob.io.base.test_utils.temporary_filename()
+  try:
+    probe = bob.bio.video.FrameContainer()
+    for i in range(5):
+      probe.add(i, numpy.random.rand(4), i / 5.)
+    algorithm = bob.bio.video.algorithm.Wrapper(LinearProjection(), compressed_io=False, model_cache_size=1000, feature_cache_size=1000)
+    algorithm.write_model(numpy.random.rand(3, 4), model_file)
+    algorithm.write_feature(probe, probe_file)
+
+    # the second read is taken from the cache
+    model = algorithm.read_model(model_file)
+    assert algorithm.read_model(model_file) is model
+    assert (algorithm.model_cache.hits, algorithm.model_cache.misses) == (1, 1)
+    features = algorithm.read_feature(probe_file)
+    assert features.is_similar_to(probe)
+    assert algorithm.read_feature(probe_file) is features
+    assert (algorithm.feature_cache.hits, algorithm.feature_cache.misses) == (1, 1)
+
+    # frame selection while reading is not cached
+    algorithm.read_feature(probe_file, bob.bio.video.FrameSelector(max_number_of_frames=2))
+    assert (algorithm.feature_cache.hits, algorithm.feature_cache.misses) == (1, 1)
+
+  finally:
+    for filename in (model_file, probe_file):
+      if os.path.exists(filename):
+        os.remove(filename)
+
+
+def test_gallery_index():
+  # 50 models with 3 frames around different centers
+  numpy.random.seed(5)
+  centers = numpy.random.randn(50, 8)
+  models = [center + numpy.random.randn(3, 8) * 0.05 for center in centers]
+  probe = bob.bio.video.FrameContainer()
+  for i in range(4):
+    probe.add(i, centers[17] + numpy.random.randn(8) * 0.05)
+
+  algorithm = bob.bio.video.algorithm.Wrapper(LinearProjection(), compressed_io=False, frame_scorer='cosine', score_fusion='max')
+  index = bob.bio.video.algorithm.GalleryIndex(algorithm, number_of_lists=8, lists_per_frame=2, max_candidates=10)
+  for i, model in enumerate(models):
+    index.add("model_%d" % i, model)
+  assert len(index) == 50
+
+  results = index.search(probe, k=3)
+  assert len(results) == 3
+  # the results are re-ranked with the exact scores
+  assert results[0][0] == "model_17", results
+  assert abs(results[0][1] - algorithm.score(models[17], probe)) < 1e-8
+  assert results[0][1] >= results[1][1] >= results[2][1]
+
+  # models added after building the index are found
+  index.add("new", centers[17] + 0.01)
+  assert "new" in [model_id for model_id, _ in index.search(probe, k=3)]
+
+  # the index can be saved and loaded
+  filename = bob.io.base.test_utils.temporary_filename()
+  try:
+    index.save(bob.io.base.HDF5File(filename, 'w'))
+    loaded = bob.bio.video.algorithm.GalleryIndex(algorithm, number_of_lists=8, lists_per_frame=2, max_candidates=10)
+    loaded.load(bob.io.base.HDF5File(filename))
+    assert len(loaded) == 51
+    assert loaded.search(probe, k=3) == index.search(probe, k=3)
+  finally:
+    if os.path.exists(filename):
+      os.remove(filename)
@@ -1,5 +1,6 @@
 import os
 import collections
+import numpy
 import bob.io.base
 import bob.io.image
 import bob.io.video
@@ -98,3 +99,116 @@ def test_failsafe_video():
     assert 'topleft' in annotations, annot
     assert annotations['topleft'] == (0, 0), annot
     assert annotations['bottomright'] == (64, 64), annot
+
+
+class SquareAnnotator(bob.bio.base.annotator.Annotator):
+  """An annotator that finds the bright square in the image and counts its
+  calls."""
+
+  def __init__(self, **kwargs):
+    super(SquareAnnotator, self).__init__(**kwargs)
+    self.calls = 0
+
+  def annotate(self, image, **kwargs):
+    self.calls += 1
+    self.shape = image.shape
+    y, x = numpy.nonzero(image > 0)
+    return {
+        'topleft': (y.min(), x.min()),
+        'bottomright': (y.max() + 1, x.max() + 1),
+        'center': ((y.min() + y.max() + 1) / 2., (x.min() + x.max() + 1) / 2.),
+    }
+
+
+def test_detect_and_track():
+  # a textured square that moves by one pixel per frame
+  numpy.random.seed(42)
+  texture = numpy.random.randint(1, 255, (20, 20))
+  video = numpy.zeros((12, 100, 100), numpy.uint8)
+  for i in range(12):
+    video[i, 30 + i:50 + i, 40 + i:60 + i] = texture
+
+  annotator = bob.bio.video.annotator.DetectAndTrack(
+      SquareAnnotator(), detection_interval=5)
+  annot = annotator(video)
+
+  # the detector is only run on every fifth frame
+  assert annotator.annotator.calls == 3, annotator.annotator.calls
+  assert list(annot.keys()) == [str(i) for i in range(12)], annot
+  for i in range(12):
+    assert annot[str(i)]['topleft'] == (30 + i, 40 + i), annot
+    assert annot[str(i)]['bottomright'] == (50 + i, 60 + i), annot
+    assert annot[str(i)]['center'] == (40 + i, 50 + i), annot
+
+  # the face is detected again when tracking fails
+  video[3] = numpy.random.randint(1, 255, (100, 100))
+  annotator = bob.bio.video.annotator.DetectAndTrack(
+      SquareAnnotator(), detection_interval=5)
+  annot = annotator(video)
+  assert annotator.annotator.calls == 4, annotator.annotator.calls
+
+
+class EyesAnnotator(bob.bio.base.annotator.Annotator):
+  """An annotator that returns eye positions without a bounding box and counts
+  its calls."""
+
+  def __init__(self, **kwargs):
+    super(EyesAnnotator, self).__init__(**kwargs)
+    self.calls = 0
+
+  def annotate(self, image, **kwargs):
+    self.calls += 1
+    return {'reye': (10, 10), 'leye': (10, 20)}
+
+
+def test_detect_and_track_without_box():
+  # annotations without a bounding box are kept, and the detector runs on
+  # every frame
+  video = numpy.random.randint(1, 255, (4, 40, 40)).astype(numpy.uint8)
+  annotator = bob.bio.video.annotator.DetectAndTrack(
+      EyesAnnotator(), detection_interval=5)
+  annot = annotator(video)
+  assert annotator.annotator.calls == 4, annotator.annotator.calls
+  assert list(annot.keys()) == ['0', '1', '2', '3'], annot
+  for a in annot.values():
+    assert a == {'reye': (10, 10), 'leye': (10, 20)}, annot
+
+
+def test_detect_and_track_subsampled():
+  # a smooth texture in a large square, which is tracked on a subsampled grid,
+  # moves by one pixel down and two pixels right per frame
+  y, x = numpy.mgrid[:60, :60] / 60.
+  texture = 100 + 50 * numpy.sin(7 * y) * numpy.cos(5 * x) + \
+      40 * numpy.cos(11 * x * y)
+  video = numpy.zeros((8, 160, 160), numpy.uint8)
+  for i in range(8):
+    video[i, 30 + i:90 + i, 40 + 2 * i:100 + 2 * i] = texture
+
+  annotator = bob.bio.video.annotator.DetectAndTrack(
+      SquareAnnotator(), detection_interval=10, template_size=10)
+  annot = annotator(video)
+
+  # the boxes are found exactly, not only on the grid of the subsampling step
+  assert annotator.annotator.calls == 1, annotator.annotator.calls
+  for i in range(8):
+    assert annot[str(i)]['topleft'] == (30 + i, 40 + 2 * i), annot
+    assert annot[str(i)]['bottomright'] == (90 + i, 100 + 2 * i), annot
+
+
+def test_downscaled():
+  # a bright square in large frames
+  video = numpy.zeros((3, 200, 160), numpy.uint8)
+  video[:, 40:120, 60:100] = 200
+
+  for kwargs in ({'scale': 0.5}, {'max_size': 100}):
+    annotator = bob.bio.video.annotator.Downscaled(
+        bob.bio.video.annotator.Wrapper(SquareAnnotator()), **kwargs)
+    annot = annotator(video)
+    # the image annotator only sees downscaled frames
+    assert annotator.annotator.annotator.shape == (100, 80), \
+        annotator.annotator.annotator.shape
+    assert list(annot.keys()) == ['0', '1', '2'], annot
+    # the annotations are given in the original resolution
+    for a in annot.values():
+      assert numpy.allclose(a['topleft'], (40, 60), atol=3), a
+      assert numpy.allclose(a['bottomright'], (120, 100), atol=3), a
@@ -2,6 +2,8 @@
 # vim: set fileencoding=utf-8 :
 
 import os
+import numpy
+import nose.tools
 import bob.bio.base
 import bob.bio.base.test.dummy.extractor
 import bob.bio.video
@@ -45,3 +47,137 @@ def test_extractor():
   finally:
     if os.path.exists(filename):
       os.remove(filename)
+
+
+class FlattenExtractor(bob.bio.base.extractor.Extractor):
+  """Test extractor, which flattens the frames."""
+  def __call__(self, data):
+    return data.flatten().astype(numpy.float64)
+
+
+class BatchFlattenExtractor(FlattenExtractor):
+  """Test extractor, which flattens stacks of frames and counts the batches."""
+  def __init__(self):
+    super(BatchFlattenExtractor, self).__init__()
+    self.batch_sizes = []
+  def extract_batch(self, frames):
+    self.batch_sizes.append(len(frames))
+    return frames.reshape(len(frames), -1).astype(numpy.float64)
+
+
+def test_batch():
+  frames = bob.bio.video.FrameContainer()
+  for i in range(7):
+    frames.add(i, numpy.random.rand(4, 5), i / 7.)
+  reference = bob.bio.video.extractor.Wrapper(FlattenExtractor(), compressed_io=False)(frames)
+
+  for batch_size, batch_sizes in ((None, [7]), (3, [3, 3, 1])):
+    extractor = bob.bio.video.extractor.Wrapper(BatchFlattenExtractor(), compressed_io=False, batch_size=batch_size)
+    extracted = extractor(frames)
+    assert extractor.extractor.batch_sizes == batch_sizes
+    assert extracted.is_similar_to(reference)
+    assert [f[2] for f in extracted] == [i / 7. for i in range(7)]
+
+  # empty frame containers are not extracted, like without batches
+  extractor = bob.bio.video.extractor.Wrapper(BatchFlattenExtractor(), compressed_io=False)
+  assert extractor(bob.bio.video.FrameContainer()) is None
+  assert extractor.extractor.batch_sizes == []
+
+
+class ReadCountingExtractor(FlattenExtractor):
+  """Test extractor, which counts the frames read from file."""
+  def __init__(self):
+    super(ReadCountingExtractor, self).__init__()
+    self.reads = 0
+  def read_feature(self, feature_file):
+    self.reads += 1
+    return super(ReadCountingExtractor, self).read_feature(feature_file)
+
+
+def test_io():
+  features = bob.bio.video.FrameContainer()
+  for i in range(6):
+    features.add(i, numpy.random.rand(5), i / 6.)
+  frame_selector = bob.bio.video.FrameSelector(selection_style='step', step_size=2, max_number_of_frames=3)
+
+  filename = bob.io.base.test_utils.temporary_filename()
+  try:
+    for kwargs in ({}, {'hdf5_layout': 'dataset'}, {'lazy_io': True}, {'hdf5_layout': 'dataset', 'lazy_io': True}, {'hdf5_layout': 'dataset', 'hdf5_compression': 9}):
+      extractor = bob.bio.video.extractor.Wrapper(ReadCountingExtractor(), compressed_io=False, **kwargs)
+      extractor.write_feature(features, filename)
+      read = extractor.read_feature(filename)
+      # lazily loaded frames are read when they are accessed
+      groups = kwargs.get('hdf5_layout', 'groups') == 'groups'
+      assert extractor.extractor.reads == (6 if groups and not kwargs.get('lazy_io') else 0)
+      assert read.is_similar_to(features)
+      assert [f[2] for f in read] == [f[2] for f in features]
+
+      # only the selected frames are read
+      reads = extractor.extractor.reads
+      selected = extractor.read_feature(filename, frame_selector)
+      assert [f[0] for f in selected] == ['1', '3', '5']
+      assert selected.is_similar_to(frame_selector(features))
+      assert extractor.extractor.reads - reads == (3 if groups else 0)
+  finally:
+    if os.path.exists(filename):
+      os.remove(filename)
+
+  # the compression inside the file requires the dataset layout, and cannot be combined with compressing the whole file
+  nose.tools.assert_raises(ValueError, bob.bio.video.extractor.Wrapper, FlattenExtractor(), hdf5_compression=9)
+  nose.tools.assert_raises(ValueError, bob.bio.video.extractor.Wrapper, FlattenExtractor(), compressed_io=True, hdf5_layout='dataset', hdf5_compression=9)
+
+
+class TrainingExtractor(FlattenExtractor):
+  """Test extractor, which records the number of its training frames."""
+  def __init__(self):
+    super(TrainingExtractor, self).__init__(requires_training=True)
+  def train(self, training_data, extractor_file):
+    self.training_sizes = [len(training_data)]
+
+
+class StreamingExtractor(TrainingExtractor):
+  """Test extractor, which is trained with mini-batches."""
+  def train_batches(self, batches, extractor_file):
+    self.training_sizes = [len(batch) for batch in batches]
+
+
+def test_streaming_training():
+  training_frames = []
+  for v in range(4):
+    fc = bob.bio.video.FrameContainer()
+    for i in range(5):
+      fc.add(i, numpy.random.rand(4, 5))
+    training_frames.append(fc)
+
+  extractor = bob.bio.video.extractor.Wrapper(TrainingExtractor(), compressed_io=False)
+  extractor.train(training_frames, None)
+  assert extractor.extractor.training_sizes == [20]
+
+  extractor = bob.bio.video.extractor.Wrapper(TrainingExtractor(), compressed_io=False, max_training_frames=6)
+  extractor.train(training_frames, None)
+  assert extractor.extractor.training_sizes == [6]
+
+  extractor = bob.bio.video.extractor.Wrapper(StreamingExtractor(), compressed_io=False, training_batch_size=8)
+  extractor.train(training_frames, None)
+  assert extractor.extractor.training_sizes == [8, 8, 4]
+
+
+def test_dedup():
+  # frames 0-2 and 3-4 are near-duplicates
+  frames = bob.bio.video.FrameContainer()
+  for i, value in enumerate((0., 0.01, 0.02, 1., 1.01, 0.)):
+    frames.add(i, numpy.ones((4, 5)) * value, i / 6.)
+
+  extractor = bob.bio.video.extractor.Wrapper(BatchFlattenExtractor(), compressed_io=False, dedup_threshold=0.05)
+  extracted = extractor(frames)
+  assert extractor.extractor.batch_sizes == [3]
+  assert [f[0] for f in extracted] == ['0', '3', '5']
+
+  # near-duplicates get the features of their representative frame
+  extractor = bob.bio.video.extractor.Wrapper(BatchFlattenExtractor(), compressed_io=False, dedup_threshold=0.05, copy_duplicates=True)
+  extracted = extractor(frames)
+  assert extractor.extractor.batch_sizes == [3]
+  assert [f[0] for f in extracted] == [str(i) for i in range(6)]
+  assert [f[2] for f in extracted] == [i / 6. for i in range(6)]
+  assert numpy.allclose(extracted[4][1], 1.)
+  assert numpy.allclose(extracted[2][1], 0.)
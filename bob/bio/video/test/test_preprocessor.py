@@ -2,8 +2,11 @@
 # vim: set fileencoding=utf-8 :
 
 import os
+import shutil
 import numpy
+import nose.tools
 import bob.io.base
+import bob.io.base.test_utils
 import bob.io.image
 import bob.io.video
 import bob.bio.base
@@ -83,6 +86,227 @@ def test_missing_annotations():
     assert preprocessed_video is None
 
 
+def test_batch():
+
+    class TestPreproc(bob.bio.base.preprocessor.Preprocessor):
+        def __init__(self):
+            super(TestPreproc, self).__init__()
+            self.batches = []
+        def __call__(self, image, annotations=None):
+            raise AssertionError("The frames should be preprocessed in batches")
+        def preprocess_batch(self, images, annotations):
+            self.batches.append(len(images))
+            preprocessed = [None if annots is None else image * 2 for image, annots in zip(images, annotations)]
+            return preprocessed, [float(image.sum()) for image in images]
+
+    frames = bob.bio.video.FrameContainer()
+    for i in range(5):
+        frames.add(i, numpy.ones((4, 4)) * i)
+    annotations = dict((str(i), {'topleft': (0, 0), 'bottomright': (4, 4)}) for i in range(5) if i != 2)
+
+    preprocessor = bob.bio.video.preprocessor.Wrapper(TestPreproc(), compressed_io=False, batch_size=2)
+    preprocessed = preprocessor(frames, annotations)
+
+    assert preprocessor.preprocessor.batches == [2, 2, 1]
+    assert [x[0] for x in preprocessed] == ['0', '1', '3', '4']
+    assert numpy.allclose(preprocessed[2][1], 6)
+    assert preprocessed[2][2] == 48.
+
+
+class QualityPreprocessor(bob.bio.base.preprocessor.Preprocessor):
+    """Test preprocessor, which stores a quality; defined here to be picklable."""
+    def __init__(self):
+        super(QualityPreprocessor, self).__init__()
+    def __call__(self, image, annotations=None):
+        if annotations is None:
+            return None
+        self.quality = float(image.sum())
+        return image * 2
+
+
+def test_parallel():
+    frames = bob.bio.video.FrameContainer()
+    for i in range(20):
+        frames.add(i, numpy.ones((4, 4)) * i)
+    annotations = dict((str(i), {'topleft': (0, 0), 'bottomright': (4, 4)}) for i in range(20) if i % 3)
+
+    reference = bob.bio.video.preprocessor.Wrapper(QualityPreprocessor(), compressed_io=False)(frames, annotations)
+    assert len(reference) == 13
+
+    for parallel in ('threads', 'processes'):
+        preprocessor = bob.bio.video.preprocessor.Wrapper(QualityPreprocessor(), compressed_io=False, parallel=parallel, number_of_workers=4)
+        try:
+            preprocessed = preprocessor(frames, annotations)
+            assert preprocessed.is_similar_to(reference)
+            # the pool is reused for the next video
+            pool = preprocessor._pool
+            preprocessed = preprocessor(frames[5:], annotations)
+            assert preprocessor._pool is pool
+            assert preprocessed.is_similar_to(reference[3:])
+        finally:
+            preprocessor.close()
+        assert preprocessor._pool is None
+
+
+class BoxAnnotator(bob.bio.base.annotator.Annotator):
+    """Test annotator, which finds the non-zero pixels of the image and counts its calls."""
+    def __init__(self):
+        super(BoxAnnotator, self).__init__()
+        self.calls = 0
+    def annotate(self, image, **kwargs):
+        self.calls += 1
+        y, x = numpy.nonzero(image)
+        if not len(y):
+            return None
+        return {'topleft': (y.min(), x.min()), 'bottomright': (y.max() + 1, x.max() + 1)}
+
+
+class BoxPreprocessor(bob.bio.base.preprocessor.Preprocessor):
+    """Test preprocessor, which crops the annotated bounding box."""
+    def __init__(self):
+        super(BoxPreprocessor, self).__init__()
+    def __call__(self, image, annotations=None):
+        if annotations is None:
+            return None
+        (top, left), (bottom, right) = annotations['topleft'], annotations['bottomright']
+        return image[top:bottom, left:right].astype(numpy.float64)
+
+
+def test_annotator():
+    frames = bob.bio.video.FrameContainer()
+    for i in range(4):
+        image = numpy.zeros((10, 10))
+        image[i:i + 3, 2:6] = i + 1
+        frames.add(i, image)
+
+    # the annotations of all frames are computed by the annotator
+    preprocessor = bob.bio.video.preprocessor.Wrapper(BoxPreprocessor(), compressed_io=False, annotator=bob.bio.video.annotator.Wrapper(BoxAnnotator()))
+    preprocessed = preprocessor(frames)
+    assert preprocessor.annotator.annotator.calls == 4
+    assert [x[0] for x in preprocessed] == ['0', '1', '2', '3']
+    for i in range(4):
+        assert preprocessed[i][1].shape == (3, 4)
+        assert numpy.allclose(preprocessed[i][1], i + 1)
+
+    # given annotations take precedence over the computed ones
+    annotations = {'1': {'topleft': (0, 0), 'bottomright': (2, 2)}}
+    preprocessed = preprocessor(frames, annotations)
+    assert preprocessor.annotator.annotator.calls == 8
+    assert preprocessed[1][1].shape == (2, 2)
+    assert preprocessed[2][1].shape == (3, 4)
+
+    # the annotator is not used when all annotations are given
+    annotations = dict((str(i), {'topleft': (0, 0), 'bottomright': (2, 2)}) for i in range(4))
+    preprocessed = preprocessor(frames, annotations)
+    assert preprocessor.annotator.annotator.calls == 8
+    assert all(x[1].shape == (2, 2) for x in preprocessed)
+
+    # when preprocessing stops early, only the visited frames are annotated
+    preprocessor = bob.bio.video.preprocessor.Wrapper(BoxPreprocessor(), compressed_io=False, annotator=bob.bio.video.annotator.Wrapper(BoxAnnotator()), target_frames=2)
+    preprocessed = preprocessor(frames)
+    assert preprocessor.annotator.annotator.calls == 2
+    assert [x[0] for x in preprocessed] == ['0', '1']
+    assert numpy.allclose(preprocessed[1][1], 2)
+
+
+def test_early_stopping():
+    frames = bob.bio.video.FrameContainer()
+    for i in range(20):
+        frames.add(i, numpy.ones((4, 4)) * i)
+    annotations = dict((str(i), {'topleft': (0, 0), 'bottomright': (4, 4)}) for i in range(20))
+
+    # stop after two frames with a quality of at least 100, i.e., frames 7 and 8
+    preprocessor = bob.bio.video.preprocessor.Wrapper(QualityPreprocessor(), compressed_io=False, target_frames=2, min_quality=100)
+    preprocessed = preprocessor(frames, annotations)
+    assert [x[0] for x in preprocessed] == [str(i) for i in range(9)]
+
+    # coarse-to-fine visits frames 0, 16 and 8 first
+    preprocessor = bob.bio.video.preprocessor.Wrapper(QualityPreprocessor(), compressed_io=False, target_frames=2, min_quality=100, frame_order='coarse-to-fine')
+    preprocessed = preprocessor(frames, annotations)
+    assert [x[0] for x in preprocessed] == ['0', '8', '16']
+    assert preprocessed[2][2] == 256.
+
+
+class CountingPreprocessor(QualityPreprocessor):
+    """Test preprocessor, which counts the preprocessed frames."""
+    def __init__(self):
+        super(CountingPreprocessor, self).__init__()
+        self.calls = 0
+    def __call__(self, image, annotations=None):
+        self.calls += 1
+        return super(CountingPreprocessor, self).__call__(image, annotations)
+
+
+class BatchCountingPreprocessor(QualityPreprocessor):
+    """Test preprocessor, which preprocesses batches of frames and records the values of the preprocessed frames."""
+    def __init__(self):
+        super(BatchCountingPreprocessor, self).__init__()
+        self.preprocessed = []
+    def preprocess_batch(self, images, annotations):
+        self.preprocessed.extend(float(image[0, 0]) for image in images)
+        preprocessed = [None if annots is None else image * 2 for image, annots in zip(images, annotations)]
+        return preprocessed, [float(image.sum()) for image in images]
+
+
+def test_frame_cache():
+    frames = bob.bio.video.FrameContainer()
+    for i in range(10):
+        frames.add(i, numpy.ones((4, 4)) * i)
+    annotations = dict((str(i), {'topleft': (0, 0), 'bottomright': (4, 4)}) for i in range(10) if i % 3)
+    reference = bob.bio.video.preprocessor.Wrapper(QualityPreprocessor(), compressed_io=False)(frames, annotations)
+
+    temp_dir = bob.io.base.test_utils.temporary_filename(suffix='')
+    try:
+        cache = bob.bio.video.FrameCache(temp_dir)
+        preprocessor = bob.bio.video.preprocessor.Wrapper(CountingPreprocessor(), compressed_io=False, frame_cache=cache, cache_config='quality')
+        preprocessed = preprocessor(frames, annotations)
+        assert preprocessed.is_similar_to(reference)
+        assert preprocessor.preprocessor.calls == 10
+
+        # a different selection of frames is taken from the cache, including the failed frames
+        preprocessed = preprocessor(frames[2:8], annotations)
+        assert preprocessor.preprocessor.calls == 10
+        assert [x[0] for x in preprocessed] == ['2', '4', '5', '7']
+        assert preprocessed[1][2] == 64.
+        assert numpy.allclose(preprocessed[1][1], 8)
+
+        # changed frames are preprocessed again, also when preprocessing in parallel
+        preprocessor = bob.bio.video.preprocessor.Wrapper(CountingPreprocessor(), compressed_io=False, frame_cache=cache, cache_config='quality', parallel='threads', number_of_workers=2)
+        frames.add(10, numpy.ones((4, 4)) * 10)
+        annotations['10'] = annotations['1']
+        preprocessed = preprocessor(frames, annotations)
+        assert [x[0] for x in preprocessed] == [x[0] for x in reference] + ['10']
+        parallel = preprocessed
+
+        # when preprocessing in batches, only the frames that are not cached are passed to the preprocessor
+        preprocessor = bob.bio.video.preprocessor.Wrapper(BatchCountingPreprocessor(), compressed_io=False, frame_cache=cache, cache_config='quality-batch', batch_size=4)
+        preprocessed = preprocessor(frames[:10], annotations)
+        assert preprocessor.preprocessor.preprocessed == [float(i) for i in range(10)]
+        assert preprocessed.is_similar_to(reference)
+        preprocessed = preprocessor(frames, annotations)
+        assert preprocessor.preprocessor.preprocessed == [float(i) for i in range(11)]
+        assert preprocessed.is_similar_to(parallel)
+        assert [x[2] for x in preprocessed] == [x[2] for x in parallel]
+
+        # the least recently used frames are removed
+        cache = bob.bio.video.FrameCache(temp_dir, max_size=1)
+        preprocessor = bob.bio.video.preprocessor.Wrapper(CountingPreprocessor(), compressed_io=False, frame_cache=cache, cache_config='quality')
+        frames.add(11, numpy.ones((4, 4)) * 11)
+        preprocessor(frames[11:], annotations)
+        assert preprocessor.preprocessor.calls == 1
+        assert sum(len(files) for _, _, files in os.walk(temp_dir)) == 1
+        preprocessor(frames[:1], annotations)
+        assert preprocessor.preprocessor.calls == 2
+
+        # the configuration needs to be given when it cannot be taken from the preprocessor and the quality function
+        nose.tools.assert_raises(ValueError, bob.bio.video.preprocessor.Wrapper, CountingPreprocessor(), frame_cache=cache)
+        nose.tools.assert_raises(ValueError, bob.bio.video.preprocessor.Wrapper, CountingPreprocessor(), frame_cache=cache, quality_function=lambda image: image.mean())
+
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+
+
 def test_detect():
 
     # load test video
@@ -106,6 +330,72 @@ def test_detect():
     assert preprocessed_video.is_similar_to(reference_data)
 
 
+class ReadCountingPreprocessor(QualityPreprocessor):
+    """Test preprocessor, which counts the frames read from file."""
+    def __init__(self):
+        super(ReadCountingPreprocessor, self).__init__()
+        self.reads = 0
+    def read_data(self, data_file):
+        self.reads += 1
+        return super(ReadCountingPreprocessor, self).read_data(data_file)
+
+
+def test_io():
+    frames = bob.bio.video.FrameContainer()
+    for i in range(6):
+        frames.add(i, numpy.random.rand(4, 4), i / 6.)
+    frame_selector = bob.bio.video.FrameSelector(selection_style='step', step_size=2, max_number_of_frames=3)
+
+    filename = bob.io.base.test_utils.temporary_filename()
+    try:
+        for kwargs in ({}, {'hdf5_layout': 'dataset'}, {'lazy_io': True}, {'hdf5_layout': 'dataset', 'lazy_io': True}, {'hdf5_layout': 'dataset', 'hdf5_compression': 9}):
+            preprocessor = bob.bio.video.preprocessor.Wrapper(ReadCountingPreprocessor(), compressed_io=False, **kwargs)
+            preprocessor.write_data(frames, filename)
+            read = preprocessor.read_data(filename)
+            # lazily loaded frames are read when they are accessed
+            groups = kwargs.get('hdf5_layout', 'groups') == 'groups'
+            assert preprocessor.preprocessor.reads == (6 if groups and not kwargs.get('lazy_io') else 0)
+            assert read.is_similar_to(frames)
+            assert [x[2] for x in read] == [x[2] for x in frames]
+
+            # only the selected frames are read
+            reads = preprocessor.preprocessor.reads
+            selected = preprocessor.read_data(filename, frame_selector)
+            assert [x[0] for x in selected] == ['1', '3', '5']
+            assert selected.is_similar_to(frame_selector(frames))
+            assert preprocessor.preprocessor.reads - reads == (3 if groups else 0)
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    # the compression inside the file requires the dataset layout, and cannot be combined with compressing the whole file
+    nose.tools.assert_raises(ValueError, bob.bio.video.preprocessor.Wrapper, QualityPreprocessor(), hdf5_compression=9)
+    nose.tools.assert_raises(ValueError, bob.bio.video.preprocessor.Wrapper, QualityPreprocessor(), compressed_io=True, hdf5_layout='dataset', hdf5_compression=9)
+
+
+def test_preprocess_and_write():
+    frames = bob.bio.video.FrameContainer()
+    for i in range(10):
+        frames.add(i, numpy.ones((4, 4)) * i)
+    annotations = dict((str(i), {'topleft': (0, 0), 'bottomright': (4, 4)}) for i in range(10) if i % 3)
+    reference = bob.bio.video.preprocessor.Wrapper(QualityPreprocessor(), compressed_io=False)(frames, annotations)
+
+    for compressed_io in (False, True):
+        for queue_size in (0, 2):
+            preprocessor = bob.bio.video.preprocessor.Wrapper(QualityPreprocessor(), compressed_io=compressed_io, queue_size=queue_size)
+            filename = bob.io.base.test_utils.temporary_filename()
+            try:
+                # frames from a frame container and from an iterator are written the same way
+                for data in (frames, iter(list(frames))):
+                    assert preprocessor.preprocess_and_write(data, filename, annotations) == len(reference)
+                    preprocessed = preprocessor.read_data(filename)
+                    assert preprocessed.is_similar_to(reference)
+                    assert [x[2] for x in preprocessed] == [x[2] for x in reference]
+            finally:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+
 def test_flandmark():
 
     original_path = pkg_resources.resource_filename("bob.bio.video.test", "")
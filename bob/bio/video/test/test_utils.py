@@ -3,6 +3,8 @@
 
 import os
 import numpy
+import nose.tools
+import pkg_resources
 import bob.io.base
 import bob.io.base.test_utils
 import bob.io.image
@@ -46,6 +48,221 @@ def test_frame_container():
       os.remove(filename)
 
 
+def test_frame_container_array_backed():
+  # frames of the same shape and dtype are stored in a single array
+  test_data = numpy.random.randn(5,20,20)
+  frames = bob.bio.video.FrameContainer()
+  for i in range(5):
+    frames.add(i, test_data[i], i/5.)
+
+  # as_array and slicing return views, not copies
+  array = frames.as_array()
+  assert array.shape == (5,20,20)
+  assert numpy.allclose(array, test_data)
+  assert numpy.shares_memory(array, frames.as_array())
+  sliced = frames[1:4]
+  assert isinstance(sliced, bob.bio.video.FrameContainer)
+  assert len(sliced) == 3
+  assert [f[0] for f in sliced] == ['1', '2', '3']
+  assert numpy.shares_memory(sliced.as_array(), array)
+  assert frames[-1][0] == '4'
+  assert abs(frames[-1][2] - 0.8) < 1e-8
+
+  # adding to a slice must not modify the original container
+  sliced.add(10, numpy.zeros((20,20)))
+  assert len(sliced) == 4
+  assert len(frames) == 5
+  assert numpy.allclose(frames.as_array(), test_data)
+
+  # frames of different shape switch the container into list mode
+  frames.add(5, numpy.zeros((10,10)))
+  assert len(frames) == 6
+  assert [f[0] for f in frames] == [str(i) for i in range(6)]
+  assert numpy.allclose(frames[2][1], test_data[2])
+  assert frames[5][1].shape == (10,10)
+
+  # empty containers have no batches
+  assert list(bob.bio.video.FrameContainer().batches()) == []
+  assert list(bob.bio.video.FrameContainer().batches(3)) == []
+
+
+def test_frame_container_dataset_layout():
+  # Test that frames can be written into a single dataset and read back
+  filename = bob.io.base.test_utils.temporary_filename()
+
+  try:
+    test_data = [numpy.random.randn(20,20) for i in range(5)]
+    frames = bob.bio.video.FrameContainer()
+    for i in range(5):
+      frames.add(i, test_data[i], i/5. if i % 2 else None)
+
+    frames.save(bob.io.base.HDF5File(filename, 'w'), layout='dataset')
+    hdf5 = bob.io.base.HDF5File(filename, 'r')
+    assert hdf5.has_key("FrameData")
+    assert not hdf5.sub_groups(relative=True, recursive=False)
+    del hdf5
+
+    # the layout is detected automatically
+    read = bob.bio.video.FrameContainer(bob.io.base.HDF5File(filename, 'r'))
+    assert len(read) == 5
+    for i, (index, data, quality) in enumerate(read):
+      assert index == str(i)
+      assert numpy.allclose(test_data[i], data)
+      if i % 2:
+        assert abs(quality - i/5.) < 1e-8
+      else:
+        assert quality is None
+
+    # compressed frames can be read as well, also one by one
+    frames.save(bob.io.base.HDF5File(filename, 'w'), layout='dataset', compression=9)
+    read = bob.bio.video.FrameContainer(bob.io.base.HDF5File(filename, 'r'))
+    assert len(read) == 5
+    assert numpy.allclose(read.as_array(), test_data)
+    lazy = bob.bio.video.load_lazy(filename)
+    for i in (3, 0, 4):
+      index, data, quality = lazy[i]
+      assert index == str(i)
+      assert data.shape == (20,20)
+      assert numpy.allclose(data, test_data[i])
+      assert quality == frames[i][2]
+    nose.tools.assert_raises(ValueError, frames.save, bob.io.base.HDF5File(filename, 'w'), layout='groups', compression=9)
+
+    # frames of different shapes cannot be written into a single dataset
+    frames.add(5, numpy.zeros((10,10)))
+    nose.tools.assert_raises(ValueError, frames.save, bob.io.base.HDF5File(filename, 'w'), layout='dataset')
+
+  finally:
+    if os.path.exists(filename):
+      os.remove(filename)
+
+
+def test_frame_container_lazy():
+  # Test that lazily loaded frame containers read only the accessed frames
+  filename = bob.io.base.test_utils.temporary_filename()
+
+  try:
+    test_data = [numpy.random.randn(20,20) for i in range(10)]
+    frames = bob.bio.video.FrameContainer()
+    for i in range(10):
+      frames.add(i, test_data[i], i/10.)
+
+    for layout in ('groups', 'dataset'):
+      frames.save(bob.io.base.HDF5File(filename, 'w'), layout=layout)
+
+      read_frames = []
+      def load_function(hdf5):
+        data = bob.bio.base.load(hdf5)
+        read_frames.append(data)
+        return data
+
+      lazy = bob.bio.video.load_lazy(filename, load_function)
+      assert len(lazy) == 10
+      assert not read_frames
+
+      # select some frames; only those are read
+      selected = bob.bio.video.FrameSelector(selection_style='spread', max_number_of_frames=3)(lazy)
+      indices = bob.bio.base.selected_indices(10, 3)
+      assert [f[0] for f in selected] == [str(i) for i in indices]
+      for i, (index, data, quality) in zip(indices, selected):
+        assert numpy.allclose(data, test_data[i])
+        assert abs(quality - i/10.) < 1e-8
+      if layout == 'groups':
+        assert len(read_frames) == 3
+
+      # slicing does not read any data
+      del read_frames[:]
+      sliced = lazy[2:5]
+      assert len(sliced) == 3
+      assert not read_frames
+      assert numpy.allclose(sliced[-1][1], test_data[4])
+
+      # iterating reads all frames
+      assert frames.is_similar_to(lazy)
+
+  finally:
+    if os.path.exists(filename):
+      os.remove(filename)
+
+
+def test_frame_container_selected_loading():
+  # Test that a frame selector passed to the reader limits the frames read from file
+  filename = bob.io.base.test_utils.temporary_filename()
+
+  try:
+    test_data = [numpy.random.randn(20,20) for i in range(10)]
+    frames = bob.bio.video.FrameContainer()
+    for i in range(10):
+      frames.add(i, test_data[i], i/10.)
+
+    frame_selector = bob.bio.video.FrameSelector(selection_style='step', step_size=4, max_number_of_frames=2)
+    expected = frame_selector(frames)
+    assert [f[0] for f in expected] == ['2', '6']
+
+    for layout, compression in (('groups', 0), ('dataset', 0), ('dataset', 9)):
+      frames.save(bob.io.base.HDF5File(filename, 'w'), layout=layout, compression=compression)
+
+      read_frames = []
+      def load_function(hdf5):
+        data = bob.bio.base.load(hdf5)
+        read_frames.append(data)
+        return data
+
+      read = bob.bio.video.FrameContainer(bob.io.base.HDF5File(filename, 'r'), load_function, frame_selector)
+      assert read.is_similar_to(expected)
+      assert [f[1].shape for f in read] == [(20,20)] * 2
+      if layout == 'groups':
+        assert len(read_frames) == 2
+      else:
+        # the frames are read from the dataset directly
+        assert not read_frames
+
+      # all frames can be selected one by one, including the first and the last
+      read = bob.bio.video.FrameContainer(bob.io.base.HDF5File(filename, 'r'), load_function, bob.bio.video.FrameSelector(selection_style='all'))
+      assert read.is_similar_to(frames)
+
+  finally:
+    if os.path.exists(filename):
+      os.remove(filename)
+
+
+def test_frame_writer():
+  # Test that frames written one by one can be read as a frame container
+  filename = bob.io.base.test_utils.temporary_filename()
+
+  try:
+    test_data = [numpy.random.randn(20,20) for i in range(5)]
+    for layout in ('groups', 'dataset'):
+      with bob.bio.video.FrameWriter(bob.io.base.HDF5File(filename, 'w'), layout=layout, flush_interval=2) as writer:
+        for i in range(5):
+          writer.add(i, test_data[i], i/5.)
+      assert len(writer) == 5
+
+      read = bob.bio.video.FrameContainer(bob.io.base.HDF5File(filename, 'r'))
+      assert len(read) == 5
+      for i, (index, data, quality) in enumerate(read):
+        assert index == str(i)
+        assert abs(quality - i/5.) < 1e-8
+        assert numpy.allclose(test_data[i], data)
+
+    # frames can be written by a background thread
+    with bob.bio.video.FrameWriter(bob.io.base.HDF5File(filename, 'w'), queue_size=2) as writer:
+      for i in range(5):
+        writer.add(i, test_data[i], i/5.)
+    assert len(writer) == 5
+    read = bob.bio.video.FrameContainer(bob.io.base.HDF5File(filename, 'r'))
+    assert [f[0] for f in read] == [str(i) for i in range(5)]
+    assert numpy.allclose(read[4][1], test_data[4])
+
+    # the 'dataset' layout requires frames of the same shape
+    writer = bob.bio.video.FrameWriter(bob.io.base.HDF5File(filename, 'w'), layout='dataset')
+    writer.add(0, test_data[0])
+    nose.tools.assert_raises(ValueError, writer.add, 1, numpy.zeros((10,10)))
+
+  finally:
+    if os.path.exists(filename):
+      os.remove(filename)
+
+
 def test_frame_selector():
   # tests frame selector capabilities
   file_names = ['path%d/image%d.jpg' % (i,i) for i in range(10)]
@@ -113,3 +330,157 @@ def test_frame_selector():
   assert frames[1][0] == '6'
   assert numpy.allclose(frames[1][1], video_data[6])
   assert frames[1][2] is None
+
+
+def test_frame_selector_video_file():
+  # Test that selecting frames while decoding gives the same frames as loading the whole video
+  video_file = pkg_resources.resource_filename("bob.bio.video.test", "data/testvideo.avi")
+  video = bob.io.base.load(video_file)
+
+  for selection_style in ('first', 'spread', 'step', 'all'):
+    frame_selector = bob.bio.video.FrameSelector(selection_style=selection_style, max_number_of_frames=3, step_size=2)
+    decoded = frame_selector(video_file)
+    loaded = frame_selector(video)
+    assert len(decoded) == len(loaded)
+    for a, b in zip(decoded, loaded):
+      assert a[0] == b[0]
+      assert numpy.allclose(a[1], b[1])
+
+
+def test_frame_selector_iterate():
+  # Test that iterating the selected frames, with and without a background thread, gives the selected frames
+  video_file = pkg_resources.resource_filename("bob.bio.video.test", "data/testvideo.avi")
+  frame_selector = bob.bio.video.FrameSelector(selection_style='spread', max_number_of_frames=3)
+  loaded = frame_selector(bob.io.base.load(video_file))
+
+  for queue_size in (0, 2):
+    iterated = list(frame_selector.iterate(video_file, queue_size=queue_size))
+    assert len(iterated) == len(loaded)
+    for a, b in zip(iterated, loaded):
+      assert str(a[0]) == str(b[0])
+      assert numpy.allclose(a[1], b[1])
+
+
+def test_prefetch():
+  # Test that prefetching keeps the order and raises the errors of the background thread
+  assert list(bob.bio.video.prefetch(range(10), 3)) == list(range(10))
+
+  def _failing():
+    yield 1
+    raise ValueError("failed")
+
+  items = bob.bio.video.prefetch(_failing())
+  assert next(items) == 1
+  nose.tools.assert_raises(ValueError, next, items)
+
+  # stopping early does not block
+  items = bob.bio.video.prefetch(iter(range(100)), 1)
+  assert next(items) == 0
+  items.close()
+
+
+def test_training_data():
+  # Test that training frames are returned in mini-batches or sampled with bounded memory
+  training_frames = []
+  for v in range(5):
+    fc = bob.bio.video.FrameContainer()
+    for i in range(7):
+      fc.add(i, numpy.ones((2,3)) * (v * 7 + i))
+    training_frames.append(fc)
+  frame_selector = bob.bio.video.FrameSelector(selection_style='all')
+
+  batches = list(bob.bio.video.training_batches(training_frames, frame_selector, 10))
+  assert [len(b) for b in batches] == [10, 10, 10, 5]
+  assert batches[0].shape == (10, 2, 3)
+  assert numpy.allclose(numpy.concatenate(batches)[:, 0, 0], range(35))
+
+  sampled = bob.bio.video.reservoir_sample(training_frames, frame_selector, 8, seed=0)
+  assert len(sampled) == 8
+  values = [frame[0, 0] for frame in sampled]
+  # the sampled frames are unique and in their original order
+  assert values == sorted(set(values))
+  # the same seed samples the same frames
+  assert values == [frame[0, 0] for frame in bob.bio.video.reservoir_sample(training_frames, frame_selector, 8, seed=0)]
+  # all frames are returned when there are fewer than requested
+  assert len(bob.bio.video.reservoir_sample(training_frames, frame_selector, 100)) == 35
+
+
+def test_lru_cache():
+  # Test that the least recently used values are removed
+  cache = bob.bio.video.LRUCache(max_size=250)
+  for key in range(2):
+    assert cache.get(key, lambda: numpy.zeros(10)).nbytes == 80
+  assert len(cache) == 2 and cache.size() == 160
+  # access 0, so that 1 is the least recently used value
+  cache.get(0, None)
+  cache.put(2, numpy.zeros(10))
+  cache.put(3, numpy.zeros(10))
+  assert 0 in cache and 1 not in cache and 2 in cache and 3 in cache
+  assert (cache.hits, cache.misses) == (1, 2)
+  # values that are larger than the cache are not cached
+  cache.put(4, numpy.zeros(100))
+  assert 4 not in cache and len(cache) == 3
+
+
+def test_frame_selector_quality():
+  # Test that the frames with the highest quality are selected in temporal order
+  qualities = [0.5, 0.9, None, 0.1, 0.9, 0.8, 0.3, 0.95]
+  frames = bob.bio.video.FrameContainer()
+  for i, quality in enumerate(qualities):
+    frames.add(i, numpy.ones((2,2)) * i, quality)
+
+  selected = bob.bio.video.FrameSelector(selection_style='quality', max_number_of_frames=3)(frames)
+  assert [f[0] for f in selected] == ['1', '4', '7']
+  assert numpy.allclose(selected[1][1], 4)
+
+  # ties are broken by the position of the frame
+  selected = bob.bio.video.FrameSelector(selection_style='quality', max_number_of_frames=2)(frames)
+  assert [f[0] for f in selected] == ['1', '7']
+  selected = bob.bio.video.FrameSelector(selection_style='quality', max_number_of_frames=2, tie_break='last')(frames)
+  assert [f[0] for f in selected] == ['4', '7']
+
+  # selected frames keep a minimum distance
+  selected = bob.bio.video.FrameSelector(selection_style='quality', max_number_of_frames=3, min_gap=4)(frames)
+  assert [f[0] for f in selected] == ['1', '7']
+
+  # frames without quality are selected last
+  selected = bob.bio.video.FrameSelector(selection_style='quality', max_number_of_frames=20)(frames)
+  assert len(selected) == 8
+
+  # other data cannot be selected by quality
+  nose.tools.assert_raises(ValueError, bob.bio.video.FrameSelector(selection_style='quality'), numpy.zeros((5,2,2)))
+
+
+def test_frame_selector_motion():
+  # Test that frames are selected where the video changes
+  video = numpy.zeros((30, 3, 64, 64), numpy.uint8)
+  for i in range(10, 30):
+    video[i] = min(i - 9, 10) * 10
+
+  frame_selector = bob.bio.video.FrameSelector(selection_style='motion', max_number_of_frames=5)
+  frames = frame_selector(video)
+  assert [f[0] for f in frames] == ['0', '12', '14', '17', '19']
+
+  # the same frames are selected from a frame container
+  fc = bob.bio.video.FrameContainer()
+  for i in range(30):
+    fc.add(i, video[i])
+  assert [f[0] for f in frame_selector(fc)] == ['0', '12', '14', '17', '19']
+
+  # only one frame is selected from a static video
+  assert len(frame_selector(numpy.zeros((30, 64, 64)))) == 1
+
+
+def test_frame_selector_threads():
+  # Test that images loaded in parallel keep their order
+  file_names = ['path%d/image%d.jpg' % (i,i) for i in range(50)]
+
+  def image_load_function(s):
+    return os.path.dirname(s)
+
+  for selection_style in ('all', 'spread'):
+    sequential = bob.bio.video.FrameSelector(selection_style=selection_style)(file_names, image_load_function)
+    parallel = bob.bio.video.FrameSelector(selection_style=selection_style, load_threads=4)(file_names, image_load_function)
+    assert [f[0] for f in parallel] == [f[0] for f in sequential]
+    assert [f[1] for f in parallel] == [f[1] for f in sequential]
+
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import bob.bio.base
+import bob.io.base
+import collections
+import hashlib
+import numpy
+import os
+
+import logging
+logger = logging.getLogger("bob.bio.video")
+
+class FrameCache:
+  """An on-disk cache of preprocessed frames, which is addressed by the content of the frames.
+
+  The key of a frame is computed from the frame data, its annotations and the configuration of the preprocessor, see :py:meth:`key`.
+  Hence, frames that were preprocessed before with the identical configuration are found again, even when they are selected with a different :py:class:`bob.bio.video.FrameSelector`, or when they belong to another experiment.
+  Also frames, for which preprocessing failed, are cached.
+
+  Each frame is stored in a separate HDF5 file inside the given ``directory``.
+  When ``max_size`` is given, the least recently used files are removed whenever the cache grows larger than ``max_size`` bytes; the cache directory is read once, when the first frame is stored or found.
+  Without ``max_size``, looking up a frame only checks whether its file exists.
+  Several processes can share the same cache ``directory``; each process, however, counts only the files that it has seen.
+
+  **Parameters:**
+
+  directory : str
+    The directory to store the cached frames in; it is created if necessary.
+
+  max_size : int or ``None``
+    The maximum size of all cached files in bytes; if ``None``, no files are removed.
+  """
+
+  def __init__(self, directory, max_size = None):
+    self.directory = directory
+    self.max_size = max_size
+    # the keys of the cached files and their sizes, in the order of their last usage
+    self._entries = None
+    self._size = 0
+
+  def __str__(self):
+    return "%s(directory=%s, max_size=%s)" % (self.__class__.__name__, self.directory, self.max_size)
+
+  def key(self, frame, annotations = None, config = ""):
+    """key(frame, annotations = None, config = "") -> key
+
+    Computes the key of the given frame, which is a hash of the frame data, the given annotations and the configuration string of the preprocessor.
+    """
+    frame = numpy.ascontiguousarray(frame)
+    sha = hashlib.sha1()
+    sha.update(("%s %s %s %s" % (frame.dtype, frame.shape, sorted(annotations.items()) if annotations else None, config)).encode("utf-8"))
+    sha.update(frame.data)
+    return sha.hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.directory, key[:2], key + ".hdf5")
+
+  def _index(self):
+    """Returns the cached entries, reading the cache directory at first usage; the entries are only needed to remove files when ``max_size`` is given."""
+    if self._entries is None:
+      entries = []
+      if os.path.isdir(self.directory):
+        for path, _, files in os.walk(self.directory):
+          for name in files:
+            if name.endswith(".hdf5"):
+              stat = os.stat(os.path.join(path, name))
+              entries.append((stat.st_mtime, name[:-5], stat.st_size))
+      self._entries = collections.OrderedDict((key, size) for _, key, size in sorted(entries))
+      self._size = sum(self._entries.values())
+    return self._entries
+
+  def get(self, key, load_function = bob.bio.base.load):
+    """get(key, load_function = bob.bio.base.load) -> cached
+
+    Returns the cached frame with the given key as a tuple ``(preprocessed, quality)``, where ``preprocessed`` is ``None`` if preprocessing of the frame failed.
+    If the frame is not in the cache, ``None`` is returned.
+    """
+    path = self._path(key)
+    if not os.path.exists(path):
+      if self._entries is not None and key in self._entries:
+        # removed by another process
+        self._size -= self._entries.pop(key)
+      return None
+    try:
+      hdf5 = bob.io.base.HDF5File(path)
+      if hdf5.has_key("Failed"):
+        cached = (None, None)
+      else:
+        quality = hdf5.read("Quality") if hdf5.has_key("Quality") else None
+        hdf5.cd("Data")
+        cached = (load_function(hdf5), quality)
+      del hdf5
+    except RuntimeError:
+      logger.warn("Could not read cached frame '%s'", path)
+      return None
+
+    if self.max_size is not None:
+      self._used(key, path)
+    return cached
+
+  def put(self, key, preprocessed, quality = None, save_function = bob.bio.base.save):
+    """Stores the given preprocessed frame and its quality under the given key.
+    For failed frames, ``preprocessed`` is ``None``."""
+    path = self._path(key)
+    bob.io.base.create_directories_safe(os.path.dirname(path))
+    # write to a temporary file first, so that other processes never read incomplete files
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    hdf5 = bob.io.base.HDF5File(temp, 'w')
+    if preprocessed is None:
+      hdf5.set("Failed", 1)
+    else:
+      if quality is not None:
+        hdf5.set("Quality", quality)
+      hdf5.create_group("Data")
+      hdf5.cd("Data")
+      save_function(preprocessed, hdf5)
+    del hdf5
+    os.rename(temp, path)
+
+    if self.max_size is not None:
+      # the file might have been replaced with a file of another size
+      entries = self._index()
+      if key in entries:
+        self._size -= entries.pop(key)
+      self._used(key, path)
+      self._evict()
+
+  def _used(self, key, path):
+    """Marks the cached file with the given key as the most recently used one."""
+    entries = self._index()
+    size = entries.pop(key, None)
+    if size is None:
+      size = os.path.getsize(path)
+      self._size += size
+    entries[key] = size
+    # the modification time orders the files when the cache directory is read again
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+
+  def _evict(self):
+    """Removes the least recently used files until the cache is small enough."""
+    entries = self._index()
+    # never remove the entry that was added last
+    while self._size > self.max_size and len(entries) > 1:
+      key, size = next(iter(entries.items()))
+      del entries[key]
+      self._size -= size
+      try:
+        os.remove(self._path(key))
+      except OSError:
+        pass
@@ -2,39 +2,213 @@
 # vim: set fileencoding=utf-8 :
 
 import bob.bio.base
+import bob.io.base
 import numpy
 
 import logging
 logger = logging.getLogger("bob.bio.video")
 
+from .FrameWriter import FrameWriter
+
 class FrameContainer:
   """A class for reading, manipulating and saving video content.
+
+  As long as all frames are :py:class:`numpy.ndarray`\\s with the same shape
+  and dtype, they are stored in a single contiguous, growable array, and the
+  frame ids and qualities are kept in parallel lists.  In this case,
+  :py:meth:`as_array` and slicing return views into that array instead of
+  copies.  As soon as a frame is added that does not fit, the container falls
+  back to storing a list of ``(frame_id, data, quality)`` tuples.
+
+  Containers returned by :py:func:`load_lazy` only hold the frame ids and
+  qualities; the frame data is read from file when it is first accessed.
   """
 
-  def __init__(self, hdf5 = None, load_function = bob.bio.base.load):
-    self._frames = []
+  def __init__(self, hdf5 = None, load_function = bob.bio.base.load, frame_selector = None):
+    self._clear()
     if hdf5 is not None:
-      self.load(hdf5, load_function)
+      self.load(hdf5, load_function, frame_selector)
+
+  def _clear(self):
+    """Removes all frames and resets the container to array-backed mode."""
+    # list of (frame_id, data, quality) tuples, only used in list mode
+    self._frames = None
+    # array-backed storage; only the first self._count rows of self._data are valid
+    self._data = None
+    self._count = 0
+    self._ids = []
+    self._qualities = []
+    # (filename, load_function, layout, locations) of a lazily loaded container
+    self._source = None
+
+  def _is_array_backed(self):
+    return self._frames is None
+
+  def _is_lazy(self):
+    return self._source is not None
+
+  def _materialize(self):
+    """Reads the data of all frames of a lazily loaded container."""
+    if not self._is_lazy():
+      return
+    source, ids, qualities = self._source, self._ids, self._qualities
+    self._clear()
+    for frame_id, data, quality in zip(ids, _read_frames(source, range(len(ids))), qualities):
+      self.add(frame_id, data, quality)
+
+  def _fits(self, frame):
+    """Checks if the given frame can be stored in the contiguous array."""
+    if not isinstance(frame, numpy.ndarray):
+      return False
+    if self._data is None:
+      return True
+    return frame.shape == self._data.shape[1:] and frame.dtype == self._data.dtype
+
+  def _append(self, frame):
+    """Copies the given frame into the contiguous array, growing it if required."""
+    if self._data is None:
+      self._data = numpy.empty((16,) + frame.shape, frame.dtype)
+    elif self._count == len(self._data):
+      # double the capacity to get amortized constant time appends
+      data = numpy.empty((max(2 * len(self._data), 16),) + self._data.shape[1:], self._data.dtype)
+      data[:self._count] = self._data[:self._count]
+      self._data = data
+    self._data[self._count] = frame
+    self._count += 1
+
+  def _to_list(self):
+    """Switches from array-backed to list mode, keeping the frames added so far."""
+    self._frames = [(self._ids[i], self._data[i], self._qualities[i]) for i in range(self._count)]
+    self._data = None
+    self._count = 0
+    self._ids = []
+    self._qualities = []
 
   def __len__(self):
+    if self._is_lazy():
+      return len(self._ids)
+    if self._is_array_backed():
+      return self._count
     return len(self._frames)
 
   def __iter__(self):
     """Generator that returns the 3-tuple (frame_id, data, quality) for each frame."""
     # don't sort
-    for frame in self._frames:
-      yield frame
+    self._materialize()
+    if self._is_array_backed():
+      for i in range(self._count):
+        yield (self._ids[i], self._data[i], self._qualities[i])
+    else:
+      for frame in self._frames:
+        yield frame
 
   def __getitem__(self, i):
-    """Indexer (mostly used in tests)."""
+    """Indexer (mostly used in tests).
+
+    Integer indices return the 3-tuple (frame_id, data, quality) of the frame.
+    Slices return a new :py:class:`FrameContainer`, which shares the frame
+    data with this container if it is array-backed.
+    Indexing a lazily loaded container only reads the requested frames.
+    """
+    if isinstance(i, slice):
+      fc = FrameContainer()
+      if self._is_lazy():
+        filename, load_function, layout, locations = self._source
+        fc._source = (filename, load_function, layout, locations[i])
+        fc._ids = self._ids[i]
+        fc._qualities = self._qualities[i]
+      elif self._is_array_backed():
+        if self._data is not None:
+          fc._data = self._data[:self._count][i]
+          fc._count = len(fc._data)
+        fc._ids = self._ids[:self._count][i]
+        fc._qualities = self._qualities[:self._count][i]
+      else:
+        fc._frames = self._frames[i]
+      return fc
+
+    if self._is_lazy() or self._is_array_backed():
+      if i < 0:
+        i += len(self)
+      if not 0 <= i < len(self):
+        raise IndexError("FrameContainer index out of range")
+      if self._is_lazy():
+        return (self._ids[i], _read_frames(self._source, [i])[0], self._qualities[i])
+      return (self._ids[i], self._data[i], self._qualities[i])
     return self._frames[i]
 
+  def qualities(self):
+    """Returns the qualities of all frames.
+
+    The frame data of lazily loaded containers is not read.
+    """
+    if self._is_lazy() or self._is_array_backed():
+      return list(self._qualities)
+    return [quality for _, _, quality in self._frames]
+
+  def batches(self, batch_size = None):
+    """Generator that returns the frames in batches of at most ``batch_size`` frames.
+
+    Each batch is a 3-tuple (frame_ids, data, qualities), where ``data`` is a
+    :py:class:`numpy.ndarray` that stacks the frames of the batch, i.e., all
+    frames need to have the same shape.  For array-backed containers, ``data``
+    is a view into the contiguous array.  If ``batch_size`` is ``None``, all
+    frames are returned in a single batch.  An empty container has no batches.
+    """
+    self._materialize()
+    count = len(self)
+    if not count:
+      return
+    batch_size = batch_size or count
+    for start in range(0, count, batch_size):
+      stop = min(start + batch_size, count)
+      if self._is_array_backed():
+        yield self._ids[start:stop], self._data[start:stop], self._qualities[start:stop]
+      else:
+        frames = self._frames[start:stop]
+        yield [f[0] for f in frames], numpy.array([f[1] for f in frames]), [f[2] for f in frames]
+
   def add(self, frame_id, frame, quality = None):
     """Adds the frame with the given id and the given quality."""
+    self._materialize()
+    if self._is_array_backed():
+      if self._fits(frame):
+        self._append(frame)
+        self._ids.append(str(frame_id))
+        self._qualities.append(quality)
+        return
+      self._to_list()
     self._frames.append((str(frame_id), frame, quality))
 
-  def load(self, hdf5, load_function = bob.bio.base.load):
-    self._frames = []
+  def load(self, hdf5, load_function = bob.bio.base.load, frame_selector = None):
+    """Loads the frames from the given HDF5 file.
+
+    Both on-disk layouts written by :py:meth:`save` are supported and detected
+    automatically.  The ``load_function`` is only used to read frames stored
+    in the ``'groups'`` layout.
+
+    If a :py:class:`bob.bio.video.FrameSelector` is given, only the frames
+    selected by it are read from file.
+    """
+    self._clear()
+    if frame_selector is not None and frame_selector.selection == 'motion':
+      # this selection depends on the frame data, so all frames need to be read
+      self.load(hdf5, load_function)
+      selected = frame_selector(self)
+      self._clear()
+      for frame in selected:
+        self.add(*frame)
+    elif frame_selector is not None:
+      self._load_selected(hdf5, load_function, frame_selector)
+    elif hdf5.has_key("FrameData"):
+      self._load_dataset(hdf5)
+    else:
+      self._load_groups(hdf5, load_function)
+    if not len(self):
+      raise IOError("Could not load data as a Frame Container from file %s" % hdf5.filename)
+
+  def _load_groups(self, hdf5, load_function):
+    """Reads frames stored in one ``Frame_<id>`` group per frame."""
     # Read content (frames) from HDF5File
     for path in hdf5.sub_groups(relative=True, recursive=False):
       # extract frame_id
@@ -48,21 +222,40 @@ class FrameContainer:
         quality = hdf5.read("FrameQuality") if hdf5.has_key("FrameQuality") else None
         self.add(frame_id, data, quality)
         hdf5.cd("..")
-    if not len(self):
-      raise IOError("Could not load data as a Frame Container from file %s" % hdf5.filename)
 
-  def save(self, hdf5, save_function = bob.bio.base.save):
+  def _load_dataset(self, hdf5):
+    """Reads frames stored in the single ``FrameData`` dataset."""
+    self._ids = [str(frame_id) for frame_id in hdf5.lread("FrameIds")]
+    self._qualities = _read_qualities(hdf5, len(self._ids))
+    self._data = hdf5.read("FrameData")
+    self._count = len(self._ids)
+
+  def _load_selected(self, hdf5, load_function, frame_selector):
+    """Reads the frames selected by the given frame selector."""
+    layout, ids, qualities, locations = _read_locations(hdf5)
+    indices = frame_selector.select_indices(len(ids), qualities)
+    frames = _read_data(hdf5, load_function, layout, [locations[i] for i in indices])
+    for i, data in zip(indices, frames):
+      self.add(ids[i], data, qualities[i])
+
+  def save(self, hdf5, save_function = bob.bio.base.save, layout = 'groups', compression = 0):
     """ Save the content to the given HDF5 File.
-    The contained data will be written using the given save_function."""
-    if not len(self):
-      logger.warn("Saving empty FrameContainer '%s'", hdf5.filename)
-    for frame_id, data, quality in self:
-      hdf5.create_group("Frame_%s" % frame_id)
-      hdf5.cd("Frame_%s" % frame_id)
-      save_function(data, hdf5)
-      if quality is not None:
-        hdf5.set("FrameQuality", quality)
-      hdf5.cd("..")
+
+    Two on-disk layouts are supported:
+
+    * groups : Each frame is written into its own ``Frame_<id>`` group, using the given ``save_function``
+    * dataset : All frames are appended to the single chunked dataset ``FrameData``, while the ids and qualities are stored in the ``FrameIds`` and ``FrameQualities`` datasets.
+      The ``save_function`` is not used, and the container needs to be array-backed, i.e., all frames must be :py:class:`numpy.ndarray`\\s of the same shape and dtype.
+
+    The ``dataset`` layout requires only a few HDF5 operations per file instead of several per frame.
+    It can also be compressed using the HDF5 gzip filter with the given ``compression`` level between 0 (no compression) and 9.
+    Since each frame is stored in its own chunk, single frames can still be read without decompressing the others.
+    """
+    if layout == 'dataset' and not self._is_array_backed():
+      raise ValueError("The 'dataset' layout can only be used when all frames are numpy arrays of the same shape and dtype")
+    with FrameWriter(hdf5, save_function, layout, compression) as writer:
+      for frame_id, data, quality in self:
+        writer.add(frame_id, data, quality)
 
   def is_similar_to(self, other):
     if len(self) != len(other): return False
@@ -75,28 +268,99 @@ class FrameContainer:
   def as_array(self):
     """Returns the data of frames as a numpy array.
 
+    If the container is array-backed, a view into the internal array is
+    returned, i.e., no data is copied.  Otherwise, the frames are stacked into
+    a newly allocated array.
+
     Returns
     -------
     numpy.ndarray
         The frames are returned as an array with the shape of (n_frames, ...)
         like a video.
     """
+    if self._is_array_backed() and self._data is not None:
+      return self._data[:self._count]
+    if self._is_lazy():
+      self._materialize()
+      return self.as_array()
+
     def _reader(frame):
       # Each frame is assumed to be an image here. We make it a single frame
       # video here by expanding its dimensions. This way it can be used with
       # the vstack_features function.
       return frame[1][None, ...]
-    return bob.bio.base.vstack_features(_reader, self._frames, same_size=True)
+    return bob.bio.base.vstack_features(_reader, list(self), same_size=True)
+
+def _read_qualities(hdf5, count):
+  """Reads the ``FrameQualities`` dataset, where missing qualities are stored as NaN."""
+  if not hdf5.has_key("FrameQualities"):
+    return [None] * count
+  return [None if numpy.isnan(quality) else float(quality) for quality in numpy.atleast_1d(hdf5.read("FrameQualities"))]
+
+def _read_locations(hdf5):
+  """Reads frame ids, qualities and the locations of the frame data from the given file.
+
+  Returns the layout of the file, and the lists of frame ids, qualities and locations.
+  """
+  if hdf5.has_key("FrameData"):
+    ids = [str(frame_id) for frame_id in hdf5.lread("FrameIds")]
+    return 'dataset', ids, _read_qualities(hdf5, len(ids)), list(range(len(ids)))
+
+  ids, qualities, locations = [], [], []
+  for path in hdf5.sub_groups(relative=True, recursive=False):
+    if path[:6] == 'Frame_':
+      hdf5.cd(path)
+      qualities.append(hdf5.read("FrameQuality") if hdf5.has_key("FrameQuality") else None)
+      hdf5.cd("..")
+      ids.append(str(path[6:]))
+      locations.append(path)
+  return 'groups', ids, qualities, locations
+
+def _read_data(hdf5, load_function, layout, locations):
+  """Reads the data of the frames at the given locations, as returned by :py:func:`_read_locations`."""
+  if layout == 'dataset':
+    # lread reads a single frame (i.e., a single chunk) of the dataset
+    return [hdf5.lread("FrameData", location) for location in locations]
+  frames = []
+  for location in locations:
+    hdf5.cd(location)
+    frames.append(load_function(hdf5))
+    hdf5.cd("..")
+  return frames
+
+def _read_frames(source, indices):
+  """Reads the data of the frames with the given indices from the source of a lazy container."""
+  filename, load_function, layout, locations = source
+  return _read_data(bob.io.base.HDF5File(filename), load_function, layout, [locations[i] for i in indices])
+
+def load_lazy(filename, load_function = bob.bio.base.load):
+  """Opens a frame container from file without reading the frame data.
+
+  The frame ids and qualities are read immediately.  The data of a frame is
+  read from file using the given ``load_function`` when it is accessed, i.e.,
+  when indexing the container reads only the requested frames.  Iterating the
+  container or adding frames to it reads all frames at once.
+  """
+  hdf5 = bob.io.base.HDF5File(filename)
+  layout, ids, qualities, locations = _read_locations(hdf5)
+  del hdf5
+  if not ids:
+    raise IOError("Could not load data as a Frame Container from file %s" % filename)
+  fc = FrameContainer()
+  fc._source = (filename, load_function, layout, locations)
+  fc._ids = ids
+  fc._qualities = qualities
+  return fc
 
-def save_compressed(frame_container, filename, save_function, create_link=True):
+def save_compressed(frame_container, filename, save_function, create_link=True, layout='groups'):
   hdf5 = bob.bio.base.open_compressed(filename, 'w')
-  frame_container.save(hdf5, save_function)
+  frame_container.save(hdf5, save_function, layout)
   bob.bio.base.close_compressed(filename, hdf5, create_link=create_link)
   del hdf5
 
-def load_compressed(filename, load_function):
+def load_compressed(filename, load_function, frame_selector=None):
   hdf5 = bob.bio.base.open_compressed(filename, 'r')
-  fc = FrameContainer(hdf5, load_function)
+  fc = FrameContainer(hdf5, load_function, frame_selector)
   bob.bio.base.close_compressed(filename, hdf5)
   del hdf5
   return fc
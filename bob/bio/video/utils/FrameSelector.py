@@ -5,9 +5,13 @@ import bob.bio.base
 import bob.io.base
 import bob.io.image
 import bob.io.video
+import heapq
+import multiprocessing.pool
 import numpy
 import os
 import six
+import sys
+import threading
 
 import logging
 logger = logging.getLogger("bob.bio.video")
@@ -25,18 +29,39 @@ class FrameSelector:
   * step : Frames are selected every ``step_size`` indices, starting at ``step_size/2`` **Think twice if you want to have that when giving FrameContainer data!**
   * all : All frames are stored unconditionally
   * quality (only valid for FrameContainer data) : Select the frames based on the highest internally stored quality value
+  * motion : Frames are selected where the content of the video changes, i.e., more frames are taken from parts with motion or scene changes, and fewer from static parts
+
+  For the ``quality`` style, the selected frames are returned in temporal order.
+  Frames without quality are selected last.
+  Frames with the same quality are preferred by their position according to ``tie_break``, which can be ``'first'`` or ``'last'``.
+  If ``min_gap`` is positive, two selected frames are at least ``min_gap`` frames apart, in which case fewer than ``max_number_of_frames`` might be selected.
+
+  For the ``motion`` style, the mean absolute difference between consecutive, downsampled gray frames is computed.
+  Frames are spread evenly over the accumulated difference, so that fewer than ``max_number_of_frames`` are selected from videos with little change.
+  Since this requires all frames, video files are decoded twice, and images of image lists are loaded twice when selected.
+
+  Images of image lists are loaded with ``load_threads`` parallel threads, if more than one is given.
+  The order of the frames does not depend on the number of threads.
   """
 
   def __init__(self,
       max_number_of_frames = 20,
       selection_style = "spread",
-      step_size = 10
+      step_size = 10,
+      min_gap = 0,
+      tie_break = 'first',
+      load_threads = 1
   ):
-    if selection_style not in ('first', 'spread', 'step', 'all'):
-      raise ValueError("Unknown selection style '%s', choose one of ('first', 'spread', 'step', 'all')" % selection_style)
+    if selection_style not in ('first', 'spread', 'step', 'all', 'quality', 'motion'):
+      raise ValueError("Unknown selection style '%s', choose one of ('first', 'spread', 'step', 'all', 'quality', 'motion')" % selection_style)
+    if tie_break not in ('first', 'last'):
+      raise ValueError("Unknown tie break '%s', choose one of ('first', 'last')" % tie_break)
     self.selection = selection_style
     self.max_frames = max_number_of_frames
     self.step = step_size
+    self.min_gap = min_gap
+    self.tie_break = tie_break
+    self.load_threads = load_threads
 
   def __call__(self, data, load_function = bob.io.base.load):
     """Selects frames and returns them in a FrameContainer.
@@ -48,46 +73,311 @@ class FrameSelector:
     * ``numpy.array`` (3D or 4D): A video to select frames from
 
     When giving ``str`` or ``[str]`` data, the given ``load_function`` is used to read the data from file.
+    When giving ``str`` data with the default ``load_function``, the video is decoded frame by frame and only the selected frames are kept in memory.
     """
+    if self.selection == 'quality' and not isinstance(data, FrameContainer):
+      raise ValueError("The 'quality' selection style can only be used with FrameContainer data")
+
     # if given a string, first load the video
     if isinstance(data, six.string_types):
+      if load_function is bob.io.base.load:
+        fc = self._select_from_video(data)
+        if fc is not None:
+          return fc
       logger.debug("Loading video file '%s'", data)
       data = load_function(data)
 
     # first, get the indices
-    count = len(data)
-    if self.selection == 'first':
-      # get the first frames (limited by all frames)
-      indices = range(0, min(count, self.max_frames))
-    elif self.selection == 'spread':
-      # get frames lineraly spread over all frames
-      indices = bob.bio.base.selected_indices(count, self.max_frames)
-    elif self.selection == 'step':
-      indices = range(self.step//2, count, self.step)[:self.max_frames]
-    elif self.selection == 'all':
-      indices = range(0, count)
+    if self.selection == 'quality':
+      indices = self.select_indices(len(data), data.qualities())
+    elif self.selection == 'motion':
+      indices = self.select_indices(len(data), signatures=self._signatures(data, load_function))
+    else:
+      indices = self.select_indices(len(data))
 
     # now, iterate through the data
     fc = FrameContainer()
     if isinstance(data, FrameContainer):
-      indices = set(indices)
-      # frame container data, just copy
-      for i, frame in enumerate(data):
-        if i in indices:
-          fc.add(*frame)
+      # frame container data, just copy the selected frames
+      # (lazily loaded frame containers will read only these frames)
+      for i in sorted(set(indices)):
+        fc.add(*data[i])
     elif isinstance(data, numpy.ndarray):
       # select video frames
       for i in indices:
         fc.add(i, data[i])
     elif isinstance(data, list):
-      for i in indices:
-        # load image
-        image = load_function(data[i])
+      # load images
+      images = self._load_images([data[i] for i in indices], load_function)
+      for i, image in zip(indices, images):
         # save image name as well
         fc.add(os.path.basename(data[i]), image)
 
     return fc
 
+  def iterate(self, data, load_function = bob.io.base.load, queue_size = 0):
+    """Generator that yields the selected frames one after another as 3-tuples (frame_id, frame, quality).
+    The same ``data`` as in :py:meth:`__call__` are accepted.
+
+    When giving ``str`` data with the default ``load_function``, the frames are decoded only when they are requested.
+    Hence, the selected frames of a video can be processed (and written, see :py:class:`bob.bio.video.FrameWriter`) without keeping them in memory together.
+
+    If ``queue_size`` is positive, the frames are decoded by a background thread, while the previous frames are processed, see :py:func:`bob.bio.video.prefetch`.
+    """
+    frames = None
+    if isinstance(data, six.string_types) and load_function is bob.io.base.load and self.selection != 'quality':
+      frames = self._video_frames(data)
+    if frames is None:
+      frames = self(data, load_function)
+    if queue_size > 0:
+      frames = prefetch(frames, queue_size)
+    for frame in frames:
+      yield frame
+
+  def _select_from_video(self, filename):
+    """Decodes the given video file frame by frame and keeps the selected frames only.
+
+    Returns ``None`` if the file cannot be opened as a video.
+    """
+    frames = self._video_frames(filename)
+    if frames is None:
+      return None
+    fc = FrameContainer()
+    for frame in frames:
+      fc.add(*frame)
+    return fc
+
+  def _video_frames(self, filename):
+    """Opens the given video file and returns a generator decoding the selected frames.
+
+    Returns ``None`` if the file cannot be opened as a video.
+    """
+    try:
+      reader = bob.io.video.reader(filename)
+    except RuntimeError:
+      logger.debug("Could not open '%s' as a video, loading it as a whole", filename)
+      return None
+    logger.debug("Decoding video file '%s'", filename)
+
+    if self.selection == 'motion':
+      # a first pass computes the signatures of all frames, a second pass keeps the selected frames
+      signatures = numpy.concatenate([_frame_signatures(frame[None]) for frame in reader])
+      indices = set(self.select_indices(len(signatures), signatures=signatures))
+      reader = bob.io.video.reader(filename)
+    else:
+      # the indices are computed from the number of frames stored in the header
+      indices = set(self.select_indices(reader.number_of_frames))
+    return _decode(reader, indices)
+
+  def _signatures(self, data, load_function):
+    """Computes the signatures of all frames of the given data for the ``motion`` style."""
+    if isinstance(data, FrameContainer):
+      return _frame_signatures(data.as_array())
+    elif isinstance(data, numpy.ndarray):
+      return _frame_signatures(data)
+    return numpy.concatenate([_frame_signatures(image[None]) for image in self._load_images(data, load_function)])
+
+  def _load_images(self, names, load_function):
+    """Generator that loads the images with the given names in order, using ``load_threads`` threads."""
+    if self.load_threads <= 1:
+      for name in names:
+        yield load_function(name)
+      return
+    pool = multiprocessing.pool.ThreadPool(self.load_threads)
+    try:
+      # load in batches, so that only a few more images than required are kept in memory
+      batch_size = 4 * self.load_threads
+      for start in range(0, len(names), batch_size):
+        for image in pool.map(load_function, names[start:start + batch_size]):
+          yield image
+    finally:
+      pool.terminate()
+
+  def select_indices(self, count, qualities = None, signatures = None):
+    """Returns the indices of the frames that are selected from ``count`` frames.
+
+    The ``qualities`` of the frames are required by the ``quality`` selection style only.
+    The ``signatures`` of the frames are required by the ``motion`` selection style only, see :py:meth:`__call__`.
+    The indices are returned in ascending order.
+    """
+    if self.selection == 'first':
+      # get the first frames (limited by all frames)
+      return list(range(0, min(count, self.max_frames)))
+    elif self.selection == 'spread':
+      # get frames lineraly spread over all frames
+      return list(bob.bio.base.selected_indices(count, self.max_frames))
+    elif self.selection == 'step':
+      return list(range(self.step//2, count, self.step)[:self.max_frames])
+    elif self.selection == 'all':
+      return list(range(0, count))
+    elif self.selection == 'quality':
+      if qualities is None:
+        raise ValueError("The 'quality' selection style requires the qualities of the frames")
+      return self._select_by_quality(qualities)
+    elif self.selection == 'motion':
+      if signatures is None:
+        raise ValueError("The 'motion' selection style requires the frame signatures")
+      return self._select_by_motion(signatures)
+
+  def _select_by_motion(self, signatures):
+    """Returns the sorted indices of frames spread evenly over the accumulated change between frames."""
+    if not len(signatures):
+      return []
+    changes = numpy.abs(numpy.diff(signatures, axis=0)).mean(axis=1)
+    cumulative = numpy.concatenate(([0.], numpy.cumsum(changes)))
+    if cumulative[-1] <= 0:
+      # all frames are identical
+      return [0]
+    targets = numpy.linspace(0., cumulative[-1], min(self.max_frames, len(signatures)))
+    return sorted(set(int(i) for i in numpy.searchsorted(cumulative, targets)))
+
+  def _select_by_quality(self, qualities):
+    """Returns the sorted indices of the frames with the highest qualities."""
+    # frames without quality are ranked last; ties are broken by the frame index
+    sign = -1 if self.tie_break == 'first' else 1
+    keys = ((float('-inf') if quality is None else quality, sign * i, i) for i, quality in enumerate(qualities))
+    if self.min_gap <= 0:
+      # top-k in O(n log k)
+      return sorted(key[2] for key in heapq.nlargest(self.max_frames, keys))
+
+    # take frames in the order of decreasing quality, skipping the ones too close to already selected frames
+    heap = [(-quality, -rank, i) for quality, rank, i in keys]
+    heapq.heapify(heap)
+    selected = []
+    while heap and len(selected) < self.max_frames:
+      i = heapq.heappop(heap)[2]
+      if all(abs(i - j) >= self.min_gap for j in selected):
+        selected.append(i)
+    return sorted(selected)
+
   def __str__(self):
     """Writes the parameters of the FrameSelector as a string."""
+    if self.selection == 'quality':
+      return "FrameSelector(max_number_of_frames=%d, selection_style='%s', step_size=%d, min_gap=%d, tie_break='%s')" % (self.max_frames, self.selection, self.step, self.min_gap, self.tie_break)
     return "FrameSelector(max_number_of_frames=%d, selection_style='%s', step_size=%d)" % (self.max_frames, self.selection, self.step)
+
+
+def _decode(reader, indices):
+  """Generator that decodes the frames of the given video reader and yields the frames with the given indices."""
+  if not indices:
+    return
+  last = max(indices)
+  for i, frame in enumerate(reader):
+    if i in indices:
+      yield i, frame, None
+    if i >= last:
+      break
+
+
+def prefetch(iterable, queue_size = 1):
+  """prefetch(iterable, queue_size = 1) -> generator
+
+  Generator that yields the items of the given ``iterable``, which are computed by a background thread.
+
+  While the caller processes an item, up to ``queue_size`` further items are computed in advance, e.g., video frames are decoded while the previous frames are preprocessed.
+  Exceptions raised by the ``iterable`` are raised by this generator.
+  When this generator is closed before the end, the background thread stops after computing its current item.
+
+  **Parameters:**
+
+  iterable : iterable
+    The items to compute, e.g., the generator returned by :py:meth:`FrameSelector.iterate`.
+
+  queue_size : int
+    The maximum number of items that are computed in advance.
+
+  **Yields:**
+
+  item : object
+    The items of the given ``iterable``, in their original order.
+  """
+  items = six.moves.queue.Queue(max(queue_size, 1))
+  stop = threading.Event()
+
+  def _put(item):
+    # do not block forever, in case the consumer stopped
+    while not stop.is_set():
+      try:
+        items.put(item, timeout=0.1)
+        return True
+      except six.moves.queue.Full:
+        pass
+    return False
+
+  def _produce():
+    try:
+      for item in iterable:
+        if not _put((True, item)):
+          return
+      _put((False, None))
+    except Exception:
+      _put((False, sys.exc_info()))
+
+  thread = threading.Thread(target=_produce)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      is_item, item = items.get()
+      if not is_item:
+        if item is not None:
+          six.reraise(*item)
+        return
+      yield item
+  finally:
+    stop.set()
+    thread.join()
+
+
+def near_duplicates(frames, threshold, size = 32):
+  """near_duplicates(frames, threshold, size = 32) -> representatives
+
+  Finds near-duplicate frames, e.g., in consecutive frames of static videos.
+
+  The frames are subsampled to roughly ``size`` x ``size`` gray pixels.
+  A frame is a near-duplicate of the last frame that represents a group of frames, when the mean absolute difference of their subsampled pixels is at most ``threshold``; otherwise it starts a new group.
+
+  **Parameters:**
+
+  frames : :py:class:`bob.bio.video.FrameContainer` or :py:class:`numpy.ndarray`
+    The frames, which all need to have the same shape.
+
+  threshold : float
+    The maximum mean absolute difference between near-duplicate frames, in units of the pixel values.
+
+  size : int
+    The approximate size of the subsampled frames.
+
+  **Returns:**
+
+  representatives : [int]
+    For each frame, the position of the frame representing it; representative frames represent themselves.
+  """
+  if isinstance(frames, FrameContainer):
+    frames = frames.as_array()
+  signatures = _frame_signatures(numpy.asarray(frames), size)
+  representatives = []
+  current = None
+  for i, signature in enumerate(signatures):
+    # compare with the representative rather than with the previous frame, so that slow changes are not lost
+    if current is None or numpy.abs(signature - signatures[current]).mean() > threshold:
+      current = i
+    representatives.append(current)
+  return representatives
+
+
+def _frame_signatures(frames, size = 32):
+  """Computes cheap signatures of the given frames, which are used to measure the change between frames.
+
+  The frames of shape (n_frames, height, width) or (n_frames, 3, height, width) are subsampled to roughly ``size`` x ``size`` pixels and converted to gray, while frames of shape (n_frames, n_features) are used as they are.
+  Returns an array of shape (n_frames, n_pixels).
+  """
+  if frames.ndim == 2:
+    # the frames are feature vectors already
+    return frames.astype(numpy.float32)
+  height, width = frames.shape[-2:]
+  frames = frames[..., ::max(1, height // size), ::max(1, width // size)].astype(numpy.float32)
+  if frames.ndim == 4:
+    frames = frames.mean(axis=1)
+  return frames.reshape(len(frames), -1)
+
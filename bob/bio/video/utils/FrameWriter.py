@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import bob.bio.base
+import numpy
+import six
+import sys
+import threading
+
+import logging
+logger = logging.getLogger("bob.bio.video")
+
+class FrameWriter:
+  """A class for writing frames to an HDF5 file one after another.
+
+  The frames are written in the same format as :py:meth:`bob.bio.video.FrameContainer.save` does, and can be read with :py:class:`bob.bio.video.FrameContainer`.
+  Contrary to building a :py:class:`bob.bio.video.FrameContainer` and saving it afterward, the frames do not need to be kept in memory.
+  The writer can be used as a context manager, which calls :py:meth:`close` at the end:
+
+  .. code-block:: py
+
+     with FrameWriter(bob.io.base.HDF5File(filename, 'w'), layout='dataset') as writer:
+       for frame_id, frame in frames:
+         writer.add(frame_id, frame)
+
+  **Parameters:**
+
+  hdf5 : :py:class:`bob.io.base.HDF5File`
+    The HDF5 file opened for writing.
+
+  save_function : callable
+    The function used to write the data of a single frame in the ``'groups'`` layout.
+
+  layout : str
+    The on-disk layout, either ``'groups'`` or ``'dataset'``, see :py:meth:`bob.bio.video.FrameContainer.save`.
+
+  compression : int
+    The gzip compression level of the ``'dataset'`` layout.
+
+  flush_interval : int
+    If positive, the file is flushed to disk every ``flush_interval`` frames.
+
+  queue_size : int
+    If positive, the frames are written asynchronously by a background thread, while :py:meth:`add` returns immediately.
+    Up to ``queue_size`` frames are queued; when the queue is full, :py:meth:`add` waits.
+    Errors that occur while writing are raised by the next call to :py:meth:`add` or :py:meth:`close`.
+  """
+
+  def __init__(self, hdf5, save_function = bob.bio.base.save, layout = 'groups', compression = 0, flush_interval = 0, queue_size = 0):
+    if layout not in ('groups', 'dataset'):
+      raise ValueError("Unknown layout '%s', choose one of ('groups', 'dataset')" % layout)
+    if compression and layout != 'dataset':
+      raise ValueError("Compression is only supported for the 'dataset' layout")
+    self.hdf5 = hdf5
+    self.save_function = save_function
+    self.layout = layout
+    self.compression = compression
+    self.flush_interval = flush_interval
+    # the qualities of the 'dataset' layout are written at the end
+    self._qualities = []
+    self._shape = None
+    self._count = 0
+    # the queue and thread for asynchronous writing, and the exception that occurred in the thread
+    self._queue = None
+    self._thread = None
+    self._error = None
+    if queue_size > 0:
+      self._queue = six.moves.queue.Queue(queue_size)
+      self._thread = threading.Thread(target=self._write_queued)
+      self._thread.daemon = True
+      self._thread.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __len__(self):
+    return self._count
+
+  def add(self, frame_id, frame, quality = None):
+    """Writes the frame with the given id and the given quality to file."""
+    if self.layout == 'dataset':
+      if not isinstance(frame, numpy.ndarray):
+        raise ValueError("The 'dataset' layout can only be used when all frames are numpy arrays of the same shape and dtype")
+      if self._shape is None:
+        self._shape = (frame.shape, frame.dtype)
+      elif self._shape != (frame.shape, frame.dtype):
+        raise ValueError("The 'dataset' layout can only be used when all frames are numpy arrays of the same shape and dtype")
+    if self._queue is None:
+      self._write(frame_id, frame, quality)
+    else:
+      self._raise_error()
+      self._queue.put((frame_id, frame, quality))
+
+  def _write_queued(self):
+    """Writes the queued frames until ``None`` is queued; runs in the background thread."""
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      if self._error is None:
+        try:
+          self._write(*item)
+        except Exception:
+          # keep on emptying the queue, so that add() does not block
+          self._error = sys.exc_info()
+
+  def _raise_error(self):
+    if self._error is not None:
+      error, self._error = self._error, None
+      six.reraise(*error)
+
+  def _write(self, frame_id, frame, quality):
+    if self.layout == 'dataset':
+      self.hdf5.append("FrameData", frame, compression=self.compression)
+      self.hdf5.append("FrameIds", str(frame_id))
+      self._qualities.append(quality)
+    else:
+      self.hdf5.create_group("Frame_%s" % frame_id)
+      self.hdf5.cd("Frame_%s" % frame_id)
+      self.save_function(frame, self.hdf5)
+      if quality is not None:
+        self.hdf5.set("FrameQuality", quality)
+      self.hdf5.cd("..")
+
+    self._count += 1
+    if self.flush_interval > 0 and self._count % self.flush_interval == 0:
+      self.hdf5.flush()
+
+  def close(self):
+    """Writes the remaining information and flushes the file."""
+    if self._thread is not None:
+      # wait until all queued frames are written
+      self._queue.put(None)
+      self._thread.join()
+      self._thread = None
+      self._raise_error()
+    if not self._count:
+      logger.warn("Saving empty FrameContainer '%s'", self.hdf5.filename)
+    if any(quality is not None for quality in self._qualities):
+      self.hdf5.set("FrameQualities", numpy.array([numpy.nan if quality is None else quality for quality in self._qualities], numpy.float64))
+    self._qualities = []
+    self.hdf5.flush()
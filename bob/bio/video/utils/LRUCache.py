@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import collections
+import numpy
+import sys
+
+import logging
+logger = logging.getLogger("bob.bio.video")
+
+from .FrameContainer import FrameContainer
+
+class LRUCache:
+  """An in-memory cache, which is bounded by the (estimated) size of its values in bytes.
+
+  When a new value does not fit into the cache, the least recently used values are removed.
+  The number of cache hits and misses are counted in :py:attr:`hits` and :py:attr:`misses`.
+
+  The cached values are shared between all users of the cache, so they must not be modified.
+
+  **Parameters:**
+
+  max_size : int
+    The maximum size of all cached values in bytes.
+  """
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self._size = 0
+    # the cached (value, size) tuples, in the order of their last usage
+    self._entries = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def __str__(self):
+    return "%s(max_size=%d, size=%d, entries=%d, hits=%d, misses=%d)" % (self.__class__.__name__, self.max_size, self._size, len(self._entries), self.hits, self.misses)
+
+  def size(self):
+    """Returns the estimated size of all cached values in bytes."""
+    return self._size
+
+  def get(self, key, load_function):
+    """get(key, load_function) -> value
+
+    Returns the value cached under the given key.
+    If the key is not cached, the value is computed by ``load_function()`` and cached.
+    """
+    if key in self._entries:
+      self.hits += 1
+      # mark the entry as the most recently used one
+      value, size = self._entries.pop(key)
+      self._entries[key] = (value, size)
+      return value
+    self.misses += 1
+    value = load_function()
+    self.put(key, value)
+    return value
+
+  def put(self, key, value):
+    """Caches the given value under the given key; values larger than the cache are not cached."""
+    if key in self._entries:
+      self._size -= self._entries.pop(key)[1]
+    size = _size_of(value)
+    if size > self.max_size:
+      logger.debug("Value of size %d is too large to be cached", size)
+      return
+    self._entries[key] = (value, size)
+    self._size += size
+    # remove the least recently used entries
+    while self._size > self.max_size:
+      _, (_, size) = self._entries.popitem(last=False)
+      self._size -= size
+
+  def clear(self):
+    """Removes all cached values; the counters are kept."""
+    self._entries.clear()
+    self._size = 0
+
+
+def _size_of(value):
+  """Estimates the memory size of the given value in bytes."""
+  if isinstance(value, numpy.ndarray):
+    return value.nbytes
+  if isinstance(value, (list, tuple)):
+    return sys.getsizeof(value) + sum(_size_of(v) for v in value)
+  if isinstance(value, FrameContainer):
+    return sum(_size_of(frame[1]) for frame in value)
+  return sys.getsizeof(value)
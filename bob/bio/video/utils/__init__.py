@@ -1,3 +1,7 @@
-from .FrameContainer import FrameContainer, load_compressed, save_compressed
-from .FrameSelector import FrameSelector
-
+from .FrameContainer import FrameContainer, load_compressed, save_compressed, load_lazy
+from .FrameSelector import FrameSelector, prefetch, near_duplicates
+from .FrameWriter import FrameWriter
+from .FrameCache import FrameCache
+from .LRUCache import LRUCache
+from .training import training_batches, reservoir_sample
+from .scoring import stack_frames, score_matrix, fuse_scores, fuse_score_blocks, pool_frames
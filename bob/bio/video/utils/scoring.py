@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import numpy
+
+SCORERS = ('cosine', 'euclidean', 'dot')
+FUSIONS = ('max', 'mean', 'median', 'top-k', 'quality-weighted')
+POOLINGS = ('mean', 'quality-weighted', 'k-means', 'k-medoids')
+
+
+def stack_frames(frames):
+  """stack_frames(frames) -> matrix
+
+  Stacks the given frame features into a matrix with one row per frame.
+
+  **Parameters:**
+
+  frames : :py:class:`bob.bio.video.FrameContainer`, :py:class:`numpy.ndarray` or [:py:class:`numpy.ndarray`]
+    The features of the frames; a 1D array is a single frame.
+
+  **Returns:**
+
+  matrix : 2D :py:class:`numpy.ndarray`
+    The flattened features of the frames as rows.
+  """
+  if hasattr(frames, 'as_array'):
+    frames = frames.as_array()
+  matrix = numpy.asarray(frames)
+  if matrix.dtype == object:
+    raise ValueError("The frame features cannot be stacked into a matrix")
+  if matrix.ndim == 1:
+    matrix = matrix[None, :]
+  return matrix.reshape(len(matrix), -1).astype(numpy.float64)
+
+
+def score_matrix(model_frames, probe_frames, scorer = 'cosine'):
+  """score_matrix(model_frames, probe_frames, scorer = 'cosine') -> scores
+
+  Computes the similarity between all model frames and all probe frames with one matrix multiplication.
+
+  **Parameters:**
+
+  model_frames : 2D :py:class:`numpy.ndarray`
+    The model frame features as rows, see :py:func:`stack_frames`.
+
+  probe_frames : 2D :py:class:`numpy.ndarray`
+    The probe frame features as rows.
+
+  scorer : str
+    The similarity measure, one of ``'cosine'``, ``'euclidean'`` (the negative Euclidean distance) or ``'dot'``.
+
+  **Returns:**
+
+  scores : 2D :py:class:`numpy.ndarray`
+    The similarity of each model frame (row) and each probe frame (column).
+  """
+  if scorer == 'cosine':
+    model_frames = _normalize(model_frames)
+    probe_frames = _normalize(probe_frames)
+  elif scorer not in SCORERS:
+    raise ValueError("Unknown scorer '%s', choose one of %s" % (scorer, SCORERS))
+  products = numpy.dot(model_frames, probe_frames.T)
+  if scorer != 'euclidean':
+    return products
+  squared = (model_frames ** 2).sum(axis=1)[:, None] + (probe_frames ** 2).sum(axis=1)[None, :] - 2. * products
+  return -numpy.sqrt(numpy.maximum(squared, 0.))
+
+
+def fuse_scores(scores, fusion = 'mean', qualities = None, k = 5):
+  """fuse_scores(scores, fusion = 'mean', qualities = None, k = 5) -> score
+
+  Fuses the frame-by-frame scores between a model and a probe into a single score.
+
+  **Parameters:**
+
+  scores : 2D :py:class:`numpy.ndarray`
+    The scores between model frames (rows) and probe frames (columns), see :py:func:`score_matrix`.
+
+  fusion : str or callable
+    The fusion, one of:
+
+    * ``'max'``, ``'mean'``, ``'median'`` : the maximum, mean or median of all scores
+    * ``'top-k'`` : the mean of the ``k`` highest scores
+    * ``'quality-weighted'`` : the mean of the scores of each probe frame, weighted by the ``qualities`` of the probe frames
+
+    A callable is called as ``fusion(scores, qualities)``.
+
+  qualities : [float] or ``None``
+    The qualities of the probe frames; frames with a quality of ``None`` get the weight of the lowest quality.
+    If no qualities are given, the ``'quality-weighted'`` fusion is the mean.
+
+  k : int
+    The number of scores used by the ``'top-k'`` fusion.
+
+  **Returns:**
+
+  score : float
+    The fused score.
+  """
+  if callable(fusion):
+    return fusion(scores, qualities)
+  if fusion == 'max':
+    return float(scores.max())
+  if fusion == 'mean':
+    return float(scores.mean())
+  if fusion == 'median':
+    return float(numpy.median(scores))
+  if fusion == 'top-k':
+    scores = scores.ravel()
+    k = min(k, scores.size)
+    return float(numpy.partition(scores, scores.size - k)[scores.size - k:].mean())
+  if fusion == 'quality-weighted':
+    weights = _quality_weights(qualities)
+    if weights is None:
+      return float(scores.mean())
+    return float(numpy.dot(scores.mean(axis=0), weights))
+  raise ValueError("Unknown fusion '%s', choose one of %s" % (fusion, FUSIONS))
+
+
+def fuse_score_blocks(scores, counts, fusion = 'mean', qualities = None, k = 5):
+  """fuse_score_blocks(scores, counts, fusion = 'mean', qualities = None, k = 5) -> fused
+
+  Fuses the frame-by-frame scores of several models, whose frames are stacked as consecutive blocks of rows, with one probe.
+
+  The result is identical to calling :py:func:`fuse_scores` for each block, but the ``'max'``, ``'mean'`` and ``'quality-weighted'`` fusions are computed for all blocks at once.
+
+  **Parameters:**
+
+  scores : 2D :py:class:`numpy.ndarray`
+    The scores between the stacked model frames (rows) and the probe frames (columns), see :py:func:`score_matrix`.
+
+  counts : [int]
+    The number of frames of each model, i.e., the number of rows of each block.
+
+  fusion, qualities, k
+    See :py:func:`fuse_scores`.
+
+  **Returns:**
+
+  fused : 1D :py:class:`numpy.ndarray`
+    The fused score for each model.
+  """
+  counts = numpy.asarray(counts)
+  offsets = numpy.concatenate(([0], numpy.cumsum(counts)[:-1])).astype(int)
+  if fusion == 'max':
+    return numpy.maximum.reduceat(scores.max(axis=1), offsets)
+  if fusion == 'mean':
+    return numpy.add.reduceat(scores.mean(axis=1), offsets) / counts
+  if fusion == 'quality-weighted':
+    weights = _quality_weights(qualities)
+    rows = scores.mean(axis=1) if weights is None else numpy.dot(scores, weights)
+    return numpy.add.reduceat(rows, offsets) / counts
+  return numpy.array([fuse_scores(scores[o:o+c], fusion, qualities, k) for o, c in zip(offsets, counts)])
+
+
+def pool_frames(features, qualities = None, pooling = 'mean', k = 1, iterations = 20):
+  """pool_frames(features, qualities = None, pooling = 'mean', k = 1, iterations = 20) -> pooled
+
+  Aggregates the features of many frames into a fixed number of frames, e.g., to enroll compact models.
+
+  **Parameters:**
+
+  features : [:py:class:`numpy.ndarray`]
+    The features of the frames, which all need to have the same shape.
+
+  qualities : [float] or ``None``
+    The qualities of the frames, used by the ``'quality-weighted'`` pooling, see :py:func:`fuse_scores`.
+
+  pooling : str
+    How to aggregate the features:
+
+    * ``'mean'`` : the mean of all features
+    * ``'quality-weighted'`` : the mean of all features, weighted by their ``qualities``
+    * ``'k-means'`` : the centroids of ``k`` clusters of the features
+    * ``'k-medoids'`` : the features of the ``k`` frames that are closest to the ``k`` cluster centroids
+
+  k : int
+    The number of frames returned by the ``'k-means'`` and ``'k-medoids'`` pooling.
+    If there are no more than ``k`` frames, the features are returned as they are.
+
+  iterations : int
+    The maximum number of iterations of the k-means clustering.
+
+  **Returns:**
+
+  pooled : [:py:class:`numpy.ndarray`]
+    The pooled features, in the same shape as the given features.
+  """
+  if pooling not in POOLINGS:
+    raise ValueError("Unknown pooling '%s', choose one of %s" % (pooling, POOLINGS))
+  if not len(features):
+    return []
+  shape = numpy.asarray(features[0]).shape
+  matrix = stack_frames(list(features))
+  if pooling == 'mean':
+    pooled = matrix.mean(axis=0)[None, :]
+  elif pooling == 'quality-weighted':
+    weights = _quality_weights(qualities)
+    pooled = (matrix.mean(axis=0) if weights is None else numpy.dot(weights, matrix))[None, :]
+  elif len(matrix) <= k:
+    return list(features)
+  else:
+    pooled = _k_means(matrix, k, iterations)
+    if pooling == 'k-medoids':
+      # replace the centroids by the closest frames
+      distances = -score_matrix(pooled, matrix, 'euclidean')
+      pooled = matrix[sorted(set(distances.argmin(axis=1)))]
+  return [p.reshape(shape) for p in pooled]
+
+
+def _k_means(matrix, k, iterations):
+  """Clusters the rows of the given matrix into ``k`` clusters and returns the centroids."""
+  # start with frames spread over the whole video, which makes the result deterministic
+  centroids = matrix[numpy.linspace(0, len(matrix) - 1, k).astype(int)].copy()
+  assignment = None
+  for _ in range(iterations):
+    new_assignment = (-score_matrix(centroids, matrix, 'euclidean')).argmin(axis=0)
+    if assignment is not None and (new_assignment == assignment).all():
+      break
+    assignment = new_assignment
+    for c in range(k):
+      members = matrix[assignment == c]
+      # empty clusters keep their centroid
+      if len(members):
+        centroids[c] = members.mean(axis=0)
+  return centroids
+
+
+def _quality_weights(qualities):
+  """Returns the normalized weights of the probe frames for the given qualities, or ``None`` if all frames have the same weight."""
+  known = [q for q in qualities or [] if q is not None]
+  if not known:
+    return None
+  # negative qualities get no weight
+  weights = numpy.maximum(numpy.array([min(known) if q is None else q for q in qualities], numpy.float64), 0.)
+  if weights.sum() <= 0:
+    return None
+  return weights / weights.sum()
+
+
+def _normalize(matrix):
+  """Scales the rows of the given matrix to unit length."""
+  norms = numpy.sqrt((matrix ** 2).sum(axis=1))
+  norms[norms == 0] = 1.
+  return matrix / norms[:, None]
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import numpy
+
+import logging
+logger = logging.getLogger("bob.bio.video")
+
+
+def training_batches(training_frames, frame_selector, batch_size):
+  """training_batches(training_frames, frame_selector, batch_size) -> batches
+
+  Generator that yields the selected frames of the given frame containers in mini-batches.
+
+  Only the frames of one frame container and of the current batch are kept in memory.
+  Together with frame containers that are loaded by :py:func:`bob.bio.video.load_lazy`, this allows to train with more frames than fit into memory.
+
+  **Parameters:**
+
+  training_frames : [:py:class:`bob.bio.video.FrameContainer`]
+    The frame containers to train with.
+
+  frame_selector : :py:class:`bob.bio.video.FrameSelector`
+    The frame selector that selects the frames of each frame container.
+
+  batch_size : int
+    The maximum number of frames in each batch; only the last batch can be smaller.
+
+  **Yields:**
+
+  batch : :py:class:`numpy.ndarray`
+    The stacked data of the frames of the batch.
+  """
+  batch = []
+  for frames in training_frames:
+    for _, frame, _ in frame_selector(frames):
+      batch.append(frame)
+      if len(batch) == batch_size:
+        yield numpy.array(batch)
+        batch = []
+  if batch:
+    yield numpy.array(batch)
+
+
+def reservoir_sample(training_frames, frame_selector, max_frames, seed = None):
+  """reservoir_sample(training_frames, frame_selector, max_frames, seed = None) -> frames
+
+  Selects at most ``max_frames`` frames uniformly at random from the selected frames of all given frame containers.
+
+  The frames are sampled with reservoir sampling, so that only ``max_frames`` frames and the frames of one frame container are kept in memory at any time.
+
+  **Parameters:**
+
+  training_frames : [:py:class:`bob.bio.video.FrameContainer`]
+    The frame containers to sample from.
+
+  frame_selector : :py:class:`bob.bio.video.FrameSelector`
+    The frame selector that selects the frames of each frame container.
+
+  max_frames : int
+    The maximum number of frames to return.
+
+  seed : int or ``None``
+    The seed of the random number generator; use a fixed seed to sample the same frames in each run.
+
+  **Returns:**
+
+  frames : [object]
+    The data of the sampled frames, in the order of the frame containers.
+  """
+  generator = numpy.random.RandomState(seed)
+  # the sampled frames as (position, data) tuples
+  reservoir = []
+  count = 0
+  for frames in training_frames:
+    for _, frame, _ in frame_selector(frames):
+      if count < max_frames:
+        reservoir.append((count, frame))
+      else:
+        # replace a frame with probability max_frames / (count+1)
+        i = generator.randint(count + 1)
+        if i < max_frames:
+          reservoir[i] = (count, frame)
+      count += 1
+  if count > max_frames:
+    logger.info("Sampled %d of %d training frames", max_frames, count)
+  return [frame for _, frame in sorted(reservoir, key = lambda x: x[0])]